@@ -0,0 +1,201 @@
+# Approximate nearest-neighbour search over the reference embeddings
+#
+# An inverted-file (IVF) index: the embeddings are clustered with k-means into
+# nlist coarse cells and a query only scores the cards in its nprobe closest
+# cells. Optionally the residuals (embedding - cell centroid) are stored as
+# product-quantized (PQ) codes, which are scored with per-query lookup tables
+# instead of full vectors. All scores are inner products on unit vectors,
+# i.e. cosine similarities, to match the exact Retriever search.
+
+import argparse
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from embedding_index import load_index
+
+
+def assign(x, centroids):
+    # index of the closest centroid (squared euclidean distance) for each row of x
+    dists = (x * x).sum(1, keepdim=True) - 2 * x @ centroids.T + (centroids * centroids).sum(1)
+    return dists.argmin(1)
+
+
+def kmeans(x, k, iters=20, seed=0, max_points_per_centroid=64):
+    '''
+    Plain Lloyd's k-means on the rows of x, trained on a random sample of at
+    most k * max_points_per_centroid rows
+    @param x: (N, D) float tensor
+    @param k: Number of clusters
+    return centroids, assignment: (k, D) centroids and the (N,) cluster of each row
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    k = min(k, x.shape[0])
+    sample = x[torch.randperm(x.shape[0], generator=generator)[:k * max_points_per_centroid]]
+    centroids = sample[:k].clone()
+
+    for _ in range(iters):
+        assignment = assign(sample, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, sample)
+        counts = torch.bincount(assignment, minlength=k).unsqueeze(1)
+        # empty clusters keep their previous centroid
+        centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+
+    return centroids, assign(x, centroids)
+
+
+class IVFIndex:
+    def __init__(self, embeddings, nlist=256, nprobe=8, pq_m=None, pq_bits=8,
+                 rerank=0, iters=20, seed=0) -> None:
+        '''
+        Builds the index over an (N, D) matrix of L2-normalised embeddings
+        @param nlist: Number of coarse cells
+        @param nprobe: Default number of cells scored per query
+        @param pq_m: Number of PQ sub-quantizers (must divide D), None keeps full vectors
+        @param pq_bits: Bits per PQ code, at most 8
+        @param rerank: Re-score this many PQ candidates against the full vectors (0 = off)
+        '''
+        self.embeddings = embeddings
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self.pq_m = pq_m
+
+        data = embeddings.float()
+        self.centroids, assignment = kmeans(data, nlist, iters, seed)
+
+        # inverted lists, stored as one permutation of row ids plus list offsets
+        order = torch.argsort(assignment, stable=True)
+        counts = torch.bincount(assignment, minlength=self.centroids.shape[0])
+        self.list_ids = order
+        self.list_offsets = torch.cat([torch.zeros(1, dtype=torch.long), counts.cumsum(0)])
+
+        if pq_m:
+            dim = data.shape[1]
+            if dim % pq_m != 0:
+                raise ValueError(f"pq_m={pq_m} does not divide the embedding dim {dim}")
+            if not 1 <= pq_bits <= 8:
+                raise ValueError("pq_bits must be between 1 and 8")
+
+            residuals = data - self.centroids[assignment]
+            sub_dim = dim // pq_m
+            codebooks, codes = [], []
+            for j in range(pq_m):
+                sub = residuals[:, j * sub_dim:(j + 1) * sub_dim].contiguous()
+                codebook, code = kmeans(sub, 2 ** pq_bits, iters, seed + j)
+                codebooks.append(codebook)
+                codes.append(code)
+            # (m, ks, sub_dim) codebooks and (N, m) uint8 codes
+            self.codebooks = torch.stack(codebooks)
+            self.codes = torch.stack(codes, dim=1).to(torch.uint8)
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    def candidates(self, query, nprobe):
+        # row ids in the nprobe cells closest to the query, with their cell ids;
+        # cells are probed by the same euclidean distance assign() fills them by
+        # (the centroids are means, not unit vectors, so the inner product alone
+        # would favour long centroids over near ones)
+        closeness = 2 * (query @ self.centroids.T) - (self.centroids * self.centroids).sum(1)
+        cells = torch.topk(closeness, min(nprobe, self.nlist)).indices
+        ids, owners = [], []
+        for cell in cells.tolist():
+            start, end = self.list_offsets[cell].item(), self.list_offsets[cell + 1].item()
+            ids.append(self.list_ids[start:end])
+            owners.append(torch.full((end - start,), cell, dtype=torch.long))
+        return torch.cat(ids), torch.cat(owners)
+
+    def search(self, queries, n=5, nprobe=None):
+        '''
+        Approximate top n rows for each query
+        @param queries: (B, D) L2-normalised query vectors
+        @param nprobe: Overrides the default number of probed cells
+        return rows: One list of row ids per query, best first
+        '''
+        nprobe = nprobe or self.nprobe
+        results = []
+        for query in queries.float():
+            ids, owners = self.candidates(query, nprobe)
+            if len(ids) == 0:
+                results.append([])
+                continue
+
+            if self.pq_m:
+                scores = self.pq_scores(query, ids, owners)
+                if self.rerank:
+                    shortlist = torch.topk(scores, min(self.rerank, len(ids))).indices
+                    ids = ids[shortlist]
+                    scores = self.embeddings[ids].float() @ query
+            else:
+                scores = self.embeddings[ids].float() @ query
+
+            top = torch.topk(scores, min(n, len(ids))).indices
+            results.append(ids[top].tolist())
+        return results
+
+    def pq_scores(self, query, ids, owners):
+        # <q, c + r> = <q, c> + sum_j <q_j, codebook_j[code_j]>
+        m, ks, sub_dim = self.codebooks.shape
+        table = torch.einsum("md,mkd->mk", query.reshape(m, sub_dim), self.codebooks)
+        codes = self.codes[ids].long()
+        residual = table.gather(1, codes.T).sum(0)
+        return (self.centroids[owners] @ query) + residual
+
+    def save(self, path):
+        arrays = {
+            "centroids": self.centroids.numpy(),
+            "list_ids": self.list_ids.numpy(),
+            "list_offsets": self.list_offsets.numpy(),
+            "params": np.array([self.nprobe, self.rerank, self.pq_m or 0]),
+        }
+        if self.pq_m:
+            arrays["codebooks"] = self.codebooks.numpy()
+            arrays["codes"] = self.codes.numpy()
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path, embeddings):
+        '''
+        Loads an index written by save() for the same embedding matrix
+        @param path: .npz file
+        @param embeddings: The (N, D) matrix the index was built from
+        '''
+        arrays = np.load(path)
+        index = cls.__new__(cls)
+        index.embeddings = embeddings
+        index.centroids = torch.from_numpy(arrays["centroids"])
+        index.list_ids = torch.from_numpy(arrays["list_ids"])
+        index.list_offsets = torch.from_numpy(arrays["list_offsets"])
+        index.nprobe, index.rerank, pq_m = (int(v) for v in arrays["params"])
+        index.pq_m = pq_m or None
+        if index.pq_m:
+            index.codebooks = torch.from_numpy(arrays["codebooks"])
+            index.codes = torch.from_numpy(arrays["codes"])
+        if index.list_offsets[-1].item() != embeddings.shape[0]:
+            raise ValueError(f"{path} was built for a different embedding index")
+        return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build an IVF(-PQ) index for an embedding index")
+    parser.add_argument("embeddings", help="embedding index (.idx) or legacy .pt file")
+    parser.add_argument("destination", help="output .npz file")
+    parser.add_argument("--nlist", type=int, default=256)
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--pq-m", type=int, default=None)
+    parser.add_argument("--pq-bits", type=int, default=8)
+    parser.add_argument("--rerank", type=int, default=0)
+    parser.add_argument("--iters", type=int, default=20)
+    args = parser.parse_args()
+
+    embeddings = F.normalize(load_index(args.embeddings).embeddings.float(), dim=1)
+    index = IVFIndex(embeddings, nlist=args.nlist, nprobe=args.nprobe, pq_m=args.pq_m,
+                     pq_bits=args.pq_bits, rerank=args.rerank, iters=args.iters)
+    index.save(args.destination)
+    print(f"Built IVF index with {index.nlist} cells over {embeddings.shape[0]} embeddings")
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,10 @@ import os
 import requests
 from dotenv import load_dotenv
 from .init_db import get_db_connection
+from card_catalog import get_catalog
+from http_cache import get_response_cache
+from lru_cache import memoize
+from single_flight import SingleFlight
 import logging
 import pandas as pd
 
@@ -19,27 +23,57 @@ API_URL = "https://api.pokemontcg.io/v2/cards/"
 # Set up headers with API key
 headers = {"Authorization": f"Bearer {API_KEY}"}
 
+# OFFLINE_MODE=1 never calls the api, cards resolve from the local catalog only
+OFFLINE_MODE = os.getenv("OFFLINE_MODE", "0") == "1"
 
-def get_card(id):
+# concurrent get_card calls for the same card share one request
+card_flights = SingleFlight()
+
+
+def fetch_card(id):
     '''
-    Fetches the card from the tcg api and returns a json dict containing
-    the card information
+    Fetches the card from the tcg api, raises when the request fails
     @param id: The card's id
     return card: The json dict containing the card information
     '''
     # Make GET request
-    card = requests.get(API_URL + id, headers=headers)
+    card = requests.get(API_URL + id, headers=headers, timeout=10)
+    if card.status_code != 200:
+        logging.info(f"Error: {card.status_code} {card.text}")
+        card.raise_for_status()
+    return card.json()
 
-    card_info = card.json()
 
-    # Check if request was successful
-    if card.status_code == 200:
-        # Print JSON response
-        logging.info(
-            f"Success {card.status_code}! Retrieved info for card -> {card_info['data']['id']}: {card_info['data']['name']}")
-        return card_info
-    else:
-        logging.info("Error:", card.status_code, card.text)
+def get_card(id):
+    '''
+    Returns a json dict containing the card information, with prices.
+    The tcg api is called through the on-disk response cache (see
+    http_cache.py), so recently fetched cards need no request. When the api
+    cannot be reached, the card comes from the local catalog instead (see
+    card_catalog.py), without prices. Concurrent calls for the same card
+    share one request (see single_flight.py).
+    @param id: The card's id
+    return card: The json dict containing the card information
+    '''
+    catalog = get_catalog()
+    local = catalog.get(id)
+    if OFFLINE_MODE:
+        if local is None:
+            logging.info(f"Card {id} is not in the local catalog")
+            return None
+        return {"data": local}
+
+    try:
+        card_info = card_flights.do(id, lambda: get_response_cache().get_json(
+            API_URL + id, lambda: fetch_card(id), kind="prices"))
+    except (requests.RequestException, ValueError) as e:
+        logging.info(f"Could not fetch card {id}: {e}")
+        return {"data": local} if local is not None else None
+
+    logging.info(
+        f"Success! Retrieved info for card -> {card_info['data']['id']}: {card_info['data']['name']}")
+    catalog.update(card_info['data'])
+    return card_info
 
 # ============================== Data Extraction Functions ==================================
 
@@ -62,7 +96,8 @@ def extract_card_table_data(card):
     # Some cards may not have rarity
     rarity = card_data.get('rarity', 'Unknown')
     image_url = card_data['images']['small']
-    url = card_data['tcgplayer']['url']
+    # catalog cards without fetched prices have no tcgplayer entry yet
+    url = card_data.get('tcgplayer', {}).get('url')
 
     return (
         card_id,
@@ -256,6 +291,7 @@ def populate_tables(id):
         insert_into_pokemon_table(card)
         insert_into_prices_table(card)
         insert_into_tcgplayer_table(card)
+        invalidate_collection_tables()
         logging.info(f"Successfully inserted data for card {id}")
 
 
@@ -313,6 +349,16 @@ def get_price_info(id):
 
 # TODO combine certain elements for different dataframes
 
+# The collection tables are read on every Streamlit rerun but only change
+# when a card is added or deleted, so they are memoized and invalidated by
+# the writes (the TTL covers writes from other processes)
+
+def invalidate_collection_tables():
+    retrieve_card_pricing_table.cache.clear()
+    retrieve_pokemon_information_table.cache.clear()
+
+
+@memoize(max_items=1, ttl=300)
 def retrieve_card_pricing_table():
     '''
     Retrieves all cards with pricing information, grouping prices under
@@ -354,6 +400,7 @@ def retrieve_card_pricing_table():
     return df
 
 
+@memoize(max_items=1, ttl=300)
 def retrieve_pokemon_information_table():
     '''
     Retrieves all cards with pricing information, displaying:
@@ -450,6 +497,7 @@ def delete_card(id):
                 f"Successfully deleted card {id} and all related data.")
 
         conn.commit()
+        invalidate_collection_tables()
     except Exception as e:
         logging.error(f"Error deleting card {id}: {e}")
     finally:
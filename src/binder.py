@@ -0,0 +1,130 @@
+# Binder-page fast path
+#
+# 9- and 12-pocket binder pages hold their cards on a near-regular grid, so
+# full YOLO segmentation is unnecessary there. The pocket seams show up as
+# evenly spaced peaks in the horizontal / vertical edge profiles of the
+# photo; fitting a rows x cols grid to those peaks gives every pocket
+# directly, and the pockets are sliced into crops for the Retriever. When no
+# layout fits well enough the caller falls back to the detector.
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# (rows, cols) of the common pocket pages
+DEFAULT_LAYOUTS = ((3, 3), (4, 3), (3, 4))
+
+CARD_ASPECT = 63 / 88  # width / height of a standard card
+
+
+def edge_profiles(gray):
+    # mean absolute gradient of every column (vertical edges) and row (horizontal edges)
+    gx = np.abs(cv2.Sobel(gray, cv2.CV_32F, 1, 0, ksize=3))
+    gy = np.abs(cv2.Sobel(gray, cv2.CV_32F, 0, 1, ksize=3))
+    return gx.mean(axis=0), gy.mean(axis=1)
+
+
+def fit_lines(profile, cells, margin=0.2, tolerance=0.01, steps=40):
+    '''
+    Finds cells + 1 evenly spaced lines that best match the peaks of an edge profile
+    @param profile: 1-D edge profile along one image axis
+    @param cells: Number of pockets along the axis
+    @param margin: Fraction of the axis the outer lines may be inset from each edge
+    @param tolerance: Fraction of the axis a line may be off its even position
+    return score, (start, end): Contrast of the weakest inner line of the best fit (profile
+        peak at the line over the mean profile inside the pockets) and the positions of
+        the outer lines
+    '''
+    length = len(profile)
+    window = max(3, int(length * tolerance) | 1)
+    # local maxima within the tolerance window, so slightly uneven seams still score
+    peaks = cv2.dilate(profile.astype(np.float32).reshape(1, -1), np.ones((1, window), np.uint8)).ravel()
+
+    starts = np.linspace(0, margin * length, steps)
+    ends = np.linspace((1 - margin) * length, length - 1, steps)
+    spans = ends[None, :, None] - starts[:, None, None]
+    # (steps, steps, cells + 1) line positions for every start / end pair,
+    # and positions sampled over the middle half of every pocket
+    lines = starts[:, None, None] + spans * (np.arange(cells + 1) / cells)
+    inside = (np.arange(cells)[:, None] + np.linspace(0.25, 0.75, 9)).ravel() / cells
+    inside = starts[:, None, None] + spans * inside
+
+    def sample(values, positions):
+        return values[np.clip(positions.round().astype(int), 0, length - 1)]
+
+    baseline = np.maximum(sample(profile, inside).mean(axis=2, keepdims=True), 1e-6)
+    contrast = sample(peaks, lines) / baseline
+    # the outer lines are the page edge, or the page border, and locate the grid;
+    # every seam between two pockets has to stand out for the grid to count
+    i, j = np.unravel_index(np.argmax(contrast.mean(axis=2)), contrast.shape[:2])
+    score = contrast[i, j, 1:-1].min() if cells > 1 else contrast[i, j].mean()
+    return float(score), (float(starts[i]), float(ends[j]))
+
+
+class BinderGrid:
+    def __init__(self, rows, cols, x_range, y_range, score) -> None:
+        self.rows = rows
+        self.cols = cols
+        self.x_range = x_range
+        self.y_range = y_range
+        self.score = score
+
+    def cells(self):
+        # (x_min, y_min, x_max, y_max) of every pocket, row by row
+        (x0, x1), (y0, y1) = self.x_range, self.y_range
+        w, h = (x1 - x0) / self.cols, (y1 - y0) / self.rows
+        return [(x0 + c * w, y0 + r * h, x0 + (c + 1) * w, y0 + (r + 1) * h)
+                for r in range(self.rows) for c in range(self.cols)]
+
+
+def detect_grid(img, layouts=DEFAULT_LAYOUTS, min_contrast=1.8, aspect_tolerance=0.2, max_side=1024):
+    '''
+    Fits a pocket grid to a binder page photo
+    @param img: RGB numpy image
+    @param layouts: Candidate (rows, cols) layouts
+    @param min_contrast: Minimum peak contrast along both axes for the grid to be accepted
+    @param aspect_tolerance: Allowed relative deviation of the pocket aspect from a card's
+    @param max_side: The photo is downscaled to this long side for the edge analysis
+    return grid: BinderGrid in image coordinates, or None when no layout fits
+    '''
+    height, width = img.shape[:2]
+    scale = min(1.0, max_side / max(height, width))
+    small = cv2.resize(img, (round(width * scale), round(height * scale)), interpolation=cv2.INTER_AREA)
+    gray = cv2.GaussianBlur(cv2.cvtColor(small, cv2.COLOR_RGB2GRAY), (5, 5), 0)
+    col_profile, row_profile = edge_profiles(gray)
+
+    best = None
+    for rows, cols in layouts:
+        col_score, x_range = fit_lines(col_profile, cols)
+        row_score, y_range = fit_lines(row_profile, rows)
+        score = min(col_score, row_score)
+        if score < min_contrast:
+            continue
+        pocket_aspect = ((x_range[1] - x_range[0]) / cols) / ((y_range[1] - y_range[0]) / rows)
+        if abs(pocket_aspect / CARD_ASPECT - 1) > aspect_tolerance:
+            continue
+        if best is None or score > best.score:
+            best = BinderGrid(rows, cols,
+                              (x_range[0] / scale, x_range[1] / scale),
+                              (y_range[0] / scale, y_range[1] / scale), score)
+    return best
+
+
+def slice_pockets(img, grid, inset=0.04, min_std=12.0):
+    '''
+    Cuts every pocket of a grid out of the photo
+    @param img: RGB numpy image
+    @param inset: Fraction trimmed from each pocket side to drop the pocket seams
+    @param min_std: Pockets with a lower grey-level standard deviation are treated as empty
+    return bboxs, crops: xywh boxes and PIL crops of the non-empty pockets
+    '''
+    bboxs, crops = [], []
+    for x0, y0, x1, y1 in grid.cells():
+        dx, dy = (x1 - x0) * inset, (y1 - y0) * inset
+        x0, y0, x1, y1 = int(x0 + dx), int(y0 + dy), int(x1 - dx), int(y1 - dy)
+        pocket = img[y0:y1, x0:x1]
+        if pocket.size == 0 or pocket.std() < min_std:
+            continue
+        bboxs.append([(x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0])
+        crops.append(Image.fromarray(pocket))
+    return np.array(bboxs, dtype=np.float32).reshape(-1, 4), crops
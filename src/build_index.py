@@ -0,0 +1,193 @@
+# Builds the reference embedding index the Retriever loads from a folder of
+# card images (e.g. the output of images_scraping_script.py, one
+# "<card id>.png" per card).
+#
+# Images are embedded in batches across a process pool. A manifest of content
+# hashes is kept next to the index, so re-running after a new set is scraped
+# only embeds new or changed images and reuses every other vector.
+#
+# usage:
+#   python src/build_index.py images res/classification_embeddings/Resnet18_embeddings.idx --workers 4
+
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from embedding_backends import EMBEDDING_WEIGHTS, INPUT_SIZE, load_embedding_model
+from card_metadata import load_card_metadata
+from embedding_index import EmbeddingIndex, SCALE_MODES, STORAGE_DTYPES
+from retriever import make_transform
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# per worker process state, set up by init_worker
+_model = None
+_transform = None
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def init_worker(weights_path, threads, input_size=INPUT_SIZE):
+    global _model, _transform
+    torch.set_num_threads(threads)
+    _model = load_embedding_model(weights_path)
+    _transform = make_transform(input_size)
+
+
+def embed_files(paths):
+    '''
+    Embeds a batch of image files in the worker process
+    @param paths: Image file paths
+    return vectors: (len(paths), D) float32 numpy array
+    '''
+    images = []
+    for path in paths:
+        image = Image.open(path)
+        # Remove any alpha channel / palette by converting to RGB
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        images.append(_transform(image))
+    with torch.no_grad():
+        return _model(torch.stack(images)).flatten(1).numpy()
+
+
+def scan_images(image_dir):
+    # {card id: path} for every image in the folder, the file name is the card id
+    images = {}
+    for name in sorted(os.listdir(image_dir)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            images[os.path.splitext(name)[0]] = os.path.join(image_dir, name)
+    return images
+
+
+def load_previous(output_path, manifest_path, weights_hash, input_size=INPUT_SIZE):
+    # {card id: (content hash, vector)} from the last build, if it is still usable
+    if not (os.path.exists(output_path) and os.path.exists(manifest_path)):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("weights") != weights_hash:
+        print("Embedding weights changed, re-embedding everything")
+        return {}
+    if manifest.get("input_size", INPUT_SIZE) != input_size:
+        print("Input size changed, re-embedding everything")
+        return {}
+
+    index = EmbeddingIndex.load(output_path)
+    rows = {card_id: i for i, card_id in enumerate(index.card_ids)}
+    previous = {}
+    for card_id, content_hash in manifest.get("images", {}).items():
+        if card_id in rows:
+            previous[card_id] = (content_hash, index.embeddings[rows[card_id]].numpy().copy())
+    return previous
+
+
+def build_index(image_dir, output_path, manifest_path=None, weights_path=EMBEDDING_WEIGHTS,
+                workers=None, batch_size=32, storage=None, scale_mode="vector", cards_dir=None,
+                sets_path=None, input_size=INPUT_SIZE):
+    '''
+    Embeds new or changed images and writes the index and its manifest
+    @param image_dir: Folder of "<card id>.png" images
+    @param output_path: Index file to (re)write
+    @param manifest_path: Content hash manifest, defaults to "<output_path>.manifest.json"
+    @param workers: Number of embedding processes, defaults to the CPU count
+    @param batch_size: Images per forward pass
+    @param cards_dir: Folder of bulk card JSON dumps to attach set/supertype/release date metadata from
+    @param input_size: Side of the square images fed to the model, the Retriever embeds crops at the same size
+    return stats: Dict with the number of cards, embedded, reused and removed images
+    '''
+    manifest_path = manifest_path or output_path + ".manifest.json"
+    workers = workers or os.cpu_count() or 1
+    weights_hash = file_hash(weights_path)
+
+    images = scan_images(image_dir)
+    hashes = {card_id: file_hash(path) for card_id, path in images.items()}
+    previous = load_previous(output_path, manifest_path, weights_hash, input_size)
+
+    vectors = {}
+    todo = []
+    for card_id, content_hash in hashes.items():
+        if card_id in previous and previous[card_id][0] == content_hash:
+            vectors[card_id] = previous[card_id][1]
+        else:
+            todo.append(card_id)
+    reused = len(vectors)
+
+    if todo:
+        batches = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(weights_path, threads, input_size)) as pool:
+            results = pool.map(embed_files, [[images[c] for c in batch] for batch in batches])
+            for batch, batch_vectors in zip(batches, results):
+                for card_id, vector in zip(batch, batch_vectors):
+                    vectors[card_id] = vector
+                print(f"Embedded {len(vectors) - reused}/{len(todo)} images")
+
+    card_ids = sorted(vectors)
+    if card_ids:
+        matrix = torch.from_numpy(np.stack([vectors[c] for c in card_ids])).float()
+    else:
+        matrix = torch.empty((0, 512))
+    index = EmbeddingIndex(card_ids, F.normalize(matrix, dim=1), input_size=input_size)
+    if cards_dir:
+        index.attach_metadata(load_card_metadata(cards_dir, sets_path))
+
+    # write to a temporary file and swap it in, so processes that still have
+    # the old index memory-mapped keep reading a consistent file
+    tmp_path = output_path + ".tmp"
+    index.save(tmp_path, storage=storage, scale_mode=scale_mode)
+    os.replace(tmp_path, output_path)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump({"weights": weights_hash, "input_size": input_size, "images": hashes}, f, indent=4)
+
+    return {
+        "cards": len(card_ids),
+        "embedded": len(todo),
+        "reused": reused,
+        "removed": len(set(previous) - set(hashes)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or update the reference embedding index")
+    parser.add_argument("image_dir", help="folder of <card id>.png images")
+    parser.add_argument("output", help="index file the Retriever loads")
+    parser.add_argument("--manifest", default=None, help="content hash manifest, default <output>.manifest.json")
+    parser.add_argument("--weights", default=EMBEDDING_WEIGHTS, help="embedding model weights")
+    parser.add_argument("--workers", type=int, default=None, help="embedding processes, default CPU count")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--storage", choices=list(STORAGE_DTYPES), default=None,
+                        help="also store a compressed copy that the retriever scans")
+    parser.add_argument("--scale-mode", choices=SCALE_MODES, default="vector")
+    parser.add_argument("--cards", default=None, help="folder of bulk card JSON dumps for metadata")
+    parser.add_argument("--sets", default=None, help="JSON list of sets providing release dates")
+    parser.add_argument("--input-size", type=int, default=INPUT_SIZE,
+                        help="embedding input resolution, e.g. 160 together with rectified crops")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    stats = build_index(args.image_dir, args.output, args.manifest, args.weights,
+                        args.workers, args.batch_size, args.storage, args.scale_mode,
+                        args.cards, args.sets, args.input_size)
+    print(f"{stats['cards']} cards in {args.output}: {stats['embedded']} embedded, "
+          f"{stats['reused']} reused, {stats['removed']} removed "
+          f"({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# Headless bulk scanning of intake photos
+#
+# Scans a folder tree (or glob patterns) of photos across a pool of worker
+# processes, each holding its own Model, and streams one record per detected
+# card to a JSONL or CSV file as the images complete: the image, the card's
+# bbox and its top-k card ids with their similarity scores. A checkpoint next
+# to the output records every finished image and the output size after its
+# records were written, so an interrupted overnight run continues with
+# --resume: the output is cut back to the last checkpointed image (dropping
+# records of a half-written one) and finished images are skipped. A
+# throughput summary is printed at the end.
+#
+# usage:
+#   python src/bulk_scan.py res/intake --out scans.jsonl --workers 4
+#   python src/bulk_scan.py "res/intake/**/*.jpg" --out scans.csv --top-k 3 --lookup --resume
+
+import argparse
+import csv
+import glob
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import torch
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# per worker process state, set up by init_worker
+_model = None
+_options = None
+
+
+def init_worker(model_kwargs, threads, top_k, filters, lookup):
+    global _model, _options
+    from model import Model
+    torch.set_num_threads(threads)
+    _model = Model(**model_kwargs)
+    _options = {"top_k": top_k, "filters": filters, "lookup": lookup}
+
+
+def scan_file(path, model=None, options=None):
+    '''
+    Detects and identifies every card of one photo, in the worker process
+    @param path: Image file path
+    return path, records, error, seconds: One dict per card; error is the message
+        of the exception when the image could not be scanned, records are then empty
+    '''
+    model = model or _model
+    options = options or _options
+    start = time.perf_counter()
+    try:
+        detections = next(model.det.detect_batch([path]))
+        corners, matches = model.identify_cards(detections.image, detections.masks, detections.bboxs,
+                                                options["filters"], n=options["top_k"])
+        names = {}
+        if options["lookup"]:
+            lookups = model.lookup.find_all([card_ids[0] for card_ids, _ in matches if card_ids])
+            names = {result.card_id: result.card.name for result in lookups if result.ok}
+    except Exception as e:
+        return path, [], f"{type(e).__name__}: {e}", time.perf_counter() - start
+
+    records = []
+    for i, (corner, (card_ids, card_scores)) in enumerate(zip(corners, matches)):
+        record = {
+            "image": path,
+            "card": i,
+            "bbox": [int(v) for v in corner],  # x_min, y_min, x_max, y_max in pixels
+            "card_ids": card_ids,
+            # None for cards the hash prefilter identified without the model
+            "scores": [None if score is None else round(float(score), 4) for score in card_scores],
+        }
+        if options["lookup"]:
+            record["name"] = names.get(card_ids[0]) if card_ids else None
+        records.append(record)
+    return path, records, None, time.perf_counter() - start
+
+
+def list_inputs(inputs):
+    '''
+    Image files of the given folders (walked recursively), files and glob patterns
+    return paths: Sorted, without duplicates
+    '''
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for root, _, names in os.walk(item):
+                paths.update(os.path.join(root, name) for name in names
+                             if name.lower().endswith(IMAGE_EXTENSIONS))
+        elif os.path.isfile(item):
+            paths.add(item)
+        else:
+            paths.update(path for path in glob.glob(item, recursive=True)
+                         if path.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path))
+    return sorted(paths)
+
+
+class RecordWriter:
+    def __init__(self, path, checkpoint_path, top_k, lookup, resume=False) -> None:
+        '''
+        Appends card records to a JSONL or CSV file (by extension) and checkpoints finished images
+        @param resume: Continue the output of an earlier run from its checkpoint
+        '''
+        self.csv = path.lower().endswith(".csv")
+        self.top_k = top_k
+        self.lookup = lookup
+        self.checkpoint_path = checkpoint_path
+        self.done = set()
+
+        offset = 0
+        if resume and os.path.exists(checkpoint_path):
+            with open(checkpoint_path, "r+b") as f:
+                valid = 0
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        break  # torn last line of a killed run
+                    self.done.add(entry["image"])
+                    offset = entry["offset"]
+                    valid += len(line)
+                f.truncate(valid)
+        if resume and os.path.exists(path):
+            self.out = open(path, "r+b")
+            self.out.truncate(offset)
+            self.out.seek(offset)
+        else:
+            self.out = open(path, "wb")
+        self.checkpoint = open(checkpoint_path, "a" if resume else "w", encoding="utf-8")
+
+        if self.csv and self.out.tell() == 0:
+            self.out.write(self.csv_rows([self.csv_header()]))
+
+    def csv_header(self):
+        header = ["image", "card", "x_min", "y_min", "x_max", "y_max"]
+        for k in range(1, self.top_k + 1):
+            header += [f"card_id_{k}", f"score_{k}"]
+        return header + (["name"] if self.lookup else [])
+
+    def csv_row(self, record):
+        row = [record["image"], record["card"], *record["bbox"]]
+        for k in range(self.top_k):
+            found = k < len(record["card_ids"])
+            score = record["scores"][k] if found else None
+            row += [record["card_ids"][k] if found else "", "" if score is None else score]
+        return row + ([record.get("name") or ""] if self.lookup else [])
+
+    def csv_rows(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+    def write(self, path, records):
+        # the records of an image in one write, then its checkpoint entry
+        if self.csv:
+            data = self.csv_rows([self.csv_row(record) for record in records])
+        else:
+            data = "".join(json.dumps(record) + "\n" for record in records).encode("utf-8")
+        self.out.write(data)
+        self.out.flush()
+        self.checkpoint.write(json.dumps({"image": path, "offset": self.out.tell()}) + "\n")
+        self.checkpoint.flush()
+        self.done.add(path)
+
+    def close(self):
+        self.out.close()
+        self.checkpoint.close()
+
+
+def run(paths, writer, workers, threads, model_kwargs, top_k=5, filters=None, lookup=False, log=print):
+    '''
+    Scans paths across worker processes, writing records as images complete
+    return summary: Counts and timings of the run
+    '''
+    todo = [path for path in paths if path not in writer.done]
+    summary = {"images": len(paths), "skipped": len(paths) - len(todo), "scanned": 0, "failed": 0,
+               "cards": 0, "scan_time": 0.0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(model_kwargs, threads, top_k, filters, lookup)) as pool:
+        # a bounded window of submitted images, so results stream out and memory stays flat
+        queued = iter(todo)
+        pending = set()
+        while True:
+            while len(pending) < workers * 2:
+                path = next(queued, None)
+                if path is None:
+                    break
+                pending.add(pool.submit(scan_file, path))
+            if not pending:
+                break
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                path, records, error, seconds = future.result()
+                summary["scan_time"] += seconds
+                if error is not None:
+                    summary["failed"] += 1
+                    log(f"{path}: {error}")
+                    continue
+                writer.write(path, records)
+                summary["scanned"] += 1
+                summary["cards"] += len(records)
+                done = summary["scanned"] + summary["failed"]
+                if done % 50 == 0:
+                    elapsed = time.perf_counter() - start
+                    log(f"{done}/{len(todo)} images, {summary['cards']} cards, "
+                        f"{done / elapsed * 60:.1f} images/min")
+    summary["elapsed"] = time.perf_counter() - start
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Scan folders of photos headlessly into a JSONL or CSV file")
+    parser.add_argument("inputs", nargs="+", help="folders (walked recursively), image files or glob patterns")
+    parser.add_argument("--out", required=True, help="output file, .jsonl or .csv")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file, default <out>.checkpoint")
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from its checkpoint")
+    parser.add_argument("--overwrite", action="store_true", help="replace an existing output file")
+    parser.add_argument("--workers", type=int, default=max(1, min(4, (os.cpu_count() or 1) // 2)),
+                        help="worker processes, each loads its own Model")
+    parser.add_argument("--threads", type=int, default=None, help="torch threads per worker, default CPU count / workers")
+    parser.add_argument("--top-k", type=int, default=5, help="card ids reported per card")
+    parser.add_argument("--set-id", action="append", default=None, help="only match cards of this set (repeatable)")
+    parser.add_argument("--lookup", action="store_true", help="also resolve the name of the top card")
+    parser.add_argument("--rectify", action="store_true", help="warp cards upright before embedding")
+    parser.add_argument("--detector", default=None, help="detector weights, default the Model's")
+    parser.add_argument("--index", default=None, help="embedding index, default the Model's")
+    parser.add_argument("--backend", default="eager", help="embedding backend, see embedding_backends.py")
+    parser.add_argument("--embedding-model", default=None, help="embedding model file of the backend")
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or args.out + ".checkpoint"
+    if os.path.exists(args.out) and not (args.resume or args.overwrite):
+        parser.error(f"{args.out} exists, pass --resume to continue it or --overwrite to replace it")
+    paths = list_inputs(args.inputs)
+    if not paths:
+        parser.error("no images found")
+
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    model_kwargs = {"detector_path": args.detector, "index_path": args.index, "rectify": args.rectify,
+                    "embedding_backend": args.backend, "embedding_model_path": args.embedding_model,
+                    "threads": threads}
+    filters = {"set_id": args.set_id} if args.set_id else None
+
+    writer = RecordWriter(args.out, checkpoint, args.top_k, args.lookup, resume=args.resume)
+    log = lambda message: print(message, file=sys.stderr, flush=True)
+    try:
+        summary = run(paths, writer, args.workers, threads, model_kwargs, args.top_k, filters, args.lookup, log)
+    finally:
+        writer.close()
+
+    scanned, elapsed = summary["scanned"] + summary["failed"], summary["elapsed"]
+    print(f"{summary['images']} images: {summary['scanned']} scanned, {summary['failed']} failed, "
+          f"{summary['skipped']} already done; {summary['cards']} cards written to {args.out}")
+    if scanned:
+        print(f"{elapsed:.1f}s with {args.workers} workers x {threads} threads: "
+              f"{scanned / elapsed * 60:.1f} images/min, {summary['cards'] / elapsed * 60:.1f} cards/min, "
+              f"{summary['scan_time'] / scanned:.2f}s per image per worker")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# Local card catalog
+#
+# Built from the bulk set dumps in cards/ (one JSON list of cards per set, in
+# the PokemonTCG API format) and indexed by card id, so identifying a card or
+# adding it to the collection resolves its metadata with a dict lookup
+# instead of an API round trip. The bulk dumps leave out the set object and
+# the prices: the set is filled in from an optional sets dump (or a minimal
+# stand-in), and prices are merged in from the API when they are fetched.
+# The API is only needed for cards missing from the dumps and for prices.
+
+import copy
+import json
+import logging
+import os
+import threading
+
+from dacite import from_dict
+from pokemontcgsdk import Card
+
+from card_metadata import set_id_from_card_id
+import model_registry
+
+# anchored to the repository, so the catalog is the same whichever directory
+# the app, the services or the tools are started from
+CARDS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "cards"))
+
+
+def stub_set(set_id):
+    # stand-in for the set object of cards whose set is not in the sets dump
+    return {"id": set_id, "name": set_id, "series": "", "printedTotal": 0, "total": 0,
+            "legalities": {}, "ptcgoCode": None, "releaseDate": "", "updatedAt": "",
+            "images": {"symbol": "", "logo": ""}}
+
+
+class CardCatalog:
+    def __init__(self, cards_dir=CARDS_DIR, sets_path=None) -> None:
+        '''
+        @param cards_dir: Folder of <set>.json bulk card dumps
+        @param sets_path: Optional JSON list of sets (API format) embedded into their cards
+        '''
+        self.cards = {}     # card id -> card dict in the API "data" format
+        self.objects = {}   # card id -> pokemontcgsdk Card, built on first use
+        self.lock = threading.Lock()
+
+        sets = {}
+        if sets_path:
+            with open(sets_path, 'r', encoding='utf-8') as f:
+                sets = {s['id']: s for s in json.load(f)}
+
+        if not os.path.isdir(cards_dir):
+            logging.warning(f"Card dumps folder {cards_dir} not found, every card lookup goes to the API")
+        else:
+            for filename in sorted(os.listdir(cards_dir)):
+                if not filename.endswith('.json'):
+                    continue
+                with open(os.path.join(cards_dir, filename), 'r', encoding='utf-8') as f:
+                    for card in json.load(f):
+                        if 'set' not in card:
+                            set_id = set_id_from_card_id(card['id'])
+                            card['set'] = sets.get(set_id) or stub_set(set_id)
+                        self.cards[card['id']] = card
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __contains__(self, card_id):
+        return card_id in self.cards
+
+    def get(self, card_id):
+        # card dict in the API "data" format, None when the card is not in the catalog
+        return self.cards.get(card_id)
+
+    def find(self, card_id):
+        '''
+        Local counterpart of Card.find
+        return card: pokemontcgsdk Card, None when the card is not in the catalog
+        '''
+        card = self.objects.get(card_id)
+        if card is None:
+            data = self.cards.get(card_id)
+            if data is None:
+                return None
+            card = from_dict(Card, Card.transform(copy.deepcopy(data)))
+            self.objects[card_id] = card
+        return card
+
+    def update(self, data):
+        '''
+        Merges a card fetched from the API (e.g. with fresh prices) into the catalog
+        @param data: Card dict in the API "data" format
+        '''
+        with self.lock:
+            self.cards[data['id']] = {**self.cards.get(data['id'], {}), **data}
+            self.objects.pop(data['id'], None)
+
+
+def get_catalog(cards_dir=CARDS_DIR, sets_path=None):
+    # the process-wide catalog shared by the Model and the collection database
+    return model_registry.get_resource("catalog", lambda: CardCatalog(cards_dir, sets_path))
@@ -0,0 +1,170 @@
+# Concurrent card metadata lookups
+#
+# Card.find from pokemontcgsdk makes one blocking request, without a timeout,
+# per card, so a 9-card page pays nine sequential round trips. CardLookup
+# fetches the same endpoint for all cards of an image at once, with a bounded
+# number of requests in flight, a timeout per request and retries with
+# exponential backoff for timeouts, connection errors, 429 and 5xx. The
+# result of every card is reported separately, a failed card does not fail
+# the page. With a CardCatalog, cards are resolved locally and the API is
+# only asked for cards missing from it, or to refresh prices; with a
+# ResponseCache (http_cache.py) those requests are cached on disk.
+# Concurrent lookups of the same card (duplicates across pipeline workers or
+# users) share one request through a SingleFlight.
+
+import asyncio
+import copy
+import logging
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import requests
+from dacite import from_dict
+from pokemontcgsdk import Card, RestClient
+from pokemontcgsdk.config import __endpoint__
+
+from single_flight import SingleFlight
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+class LookupResult:
+    def __init__(self, card_id, card=None, error=None, attempts=0, elapsed=0.0) -> None:
+        self.card_id = card_id
+        self.card = card          # pokemontcgsdk Card, None when the lookup failed
+        self.error = error        # exception of the last attempt
+        self.attempts = attempts  # API requests made, 0 when resolved from the catalog
+        self.elapsed = elapsed    # seconds, including retries
+
+    @property
+    def ok(self):
+        return self.card is not None
+
+
+class CardLookup:
+    def __init__(self, endpoint=__endpoint__, api_key=None, max_concurrency=8, timeout=5.0,
+                 retries=3, backoff=0.5, max_backoff=8.0, catalog=None, cache=None) -> None:
+        '''
+        @param endpoint: API base URL, without the trailing /cards
+        @param api_key: API key, defaults to the key RestClient is configured with
+        @param max_concurrency: Requests in flight at a time
+        @param timeout: Seconds per request (connect and read)
+        @param retries: Retries after the first attempt for retryable failures
+        @param backoff: Delay before the first retry, doubled on every further retry (with jitter)
+        @param max_backoff: Upper bound of the delay between two attempts
+        @param catalog: Optional CardCatalog consulted before the API
+        @param cache: Optional ResponseCache the API requests go through
+        '''
+        self.endpoint = endpoint.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.catalog = catalog
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="card-lookup")
+        # one session (and connection pool) per worker thread
+        self.local = threading.local()
+        # identical lookups in flight at the same time make one request
+        self.flights = SingleFlight()
+
+    def session(self):
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.local.session = requests.Session()
+            api_key = self.api_key or RestClient.api_key
+            if api_key:
+                session.headers["X-Api-Key"] = api_key
+        return session
+
+    def fetch(self, card_id, kind="metadata"):
+        '''
+        One GET of a card, raises on failure
+        @param kind: "metadata" or "prices", the freshness needed from the response cache
+        return card: JSON dict of the card ("data" of the response)
+        '''
+        url = f"{self.endpoint}/cards/{card_id}"
+
+        def request():
+            response = self.session().get(url, timeout=self.timeout)
+            if response.status_code == 404:
+                raise LookupError(f"Card {card_id} not found")
+            response.raise_for_status()
+            return response.json()
+
+        if self.cache is None:
+            return request()["data"]
+        return self.cache.get_json(url, request, kind)["data"]
+
+    def retryable(self, error):
+        if isinstance(error, (requests.Timeout, requests.ConnectionError)):
+            return True
+        return isinstance(error, requests.HTTPError) and error.response is not None \
+            and error.response.status_code in RETRY_STATUS
+
+    def find(self, card_id, refresh=False):
+        '''
+        Looks one card up, from the catalog when possible, retrying retryable API failures.
+        Concurrent lookups of the same card share one request.
+        @param refresh: Fetch from the API even if the catalog has the card (fresh prices);
+            the catalog copy is still returned when the API cannot be reached
+        return result: LookupResult, never raises
+        '''
+        local = self.catalog.find(card_id) if self.catalog is not None else None
+        if local is not None and not refresh:
+            return LookupResult(card_id, local)
+        return self.flights.do((card_id, refresh), partial(self.request, card_id, refresh, local))
+
+    def submit(self, card_id, refresh=False):
+        # find on the bounded pool, return value: concurrent.futures.Future of the LookupResult
+        local = self.catalog.find(card_id) if self.catalog is not None else None
+        if local is not None and not refresh:
+            future = Future()
+            future.set_result(LookupResult(card_id, local))
+            return future
+        return self.flights.submit((card_id, refresh), self.executor, partial(self.request, card_id, refresh, local))
+
+    def request(self, card_id, refresh, local):
+        # the API part of find, local is the catalog copy returned when every attempt fails
+        start = time.perf_counter()
+        error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+                time.sleep(delay * random.uniform(0.5, 1.0))
+            try:
+                data = self.fetch(card_id, "prices" if refresh else "metadata")
+                # Card.transform renames price keys in place, the catalog keeps the API format
+                card = from_dict(Card, Card.transform(copy.deepcopy(data)))
+                if self.catalog is not None:
+                    self.catalog.update(data)
+                return LookupResult(card_id, card, None, attempt + 1, time.perf_counter() - start)
+            except Exception as e:
+                error = e
+                if not self.retryable(e):
+                    break
+        logging.warning(f"Lookup of card {card_id} failed after {attempt + 1} attempts: {error}")
+        return LookupResult(card_id, local, error, attempt + 1, time.perf_counter() - start)
+
+    def find_all(self, card_ids):
+        '''
+        Looks up many cards concurrently, at most max_concurrency requests at a time
+        @param card_ids: Card ids, duplicates are fetched once
+        return results: LookupResult per card id, in order
+        '''
+        futures = {card_id: self.submit(card_id) for card_id in dict.fromkeys(card_ids)}
+        return [futures[card_id].result() for card_id in card_ids]
+
+    async def find_all_async(self, card_ids):
+        # find_all for asyncio callers, the requests run on the same bounded pool
+        unique = list(dict.fromkeys(card_ids))
+        results = await asyncio.gather(*(asyncio.wrap_future(self.submit(card_id)) for card_id in unique))
+        results = dict(zip(unique, results))
+        return [results[card_id] for card_id in card_ids]
+
+    def close(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,54 @@
+# Card metadata used to partition and filter the embedding index
+#
+# Read from bulk card dumps such as cards/base1.json (a JSON list of cards in
+# the PokemonTCG API format). The bulk dumps do not embed the set object, so
+# the set id falls back to the card id prefix ("base1-4" -> "base1") and the
+# release date comes from an optional sets dump ({"id", "releaseDate", ...}).
+
+import json
+import os
+
+METADATA_FIELDS = ("set_id", "supertype", "release_date")
+
+
+def set_id_from_card_id(card_id):
+    return card_id.split('-', 1)[0]
+
+
+def card_metadata(card, release_dates=None):
+    '''
+    Extracts the partitioning fields from one card dict
+    @param card: Card in the PokemonTCG API format (the "data" object)
+    @param release_dates: Optional {set id: release date} lookup
+    return metadata: {"set_id", "supertype", "release_date"}
+    '''
+    card_set = card.get('set', {})
+    set_id = card_set.get('id') or set_id_from_card_id(card['id'])
+    release_date = card_set.get('releaseDate') or (release_dates or {}).get(set_id, '')
+    return {
+        "set_id": set_id,
+        "supertype": card.get('supertype', ''),
+        "release_date": release_date,
+    }
+
+
+def load_card_metadata(cards_dir, sets_path=None):
+    '''
+    Loads metadata for every card in a folder of bulk JSON dumps
+    @param cards_dir: Folder of <set>.json card lists
+    @param sets_path: Optional JSON list of sets providing release dates
+    return metadata: {card id: {"set_id", "supertype", "release_date"}}
+    '''
+    release_dates = {}
+    if sets_path:
+        with open(sets_path, 'r', encoding='utf-8') as f:
+            release_dates = {s['id']: s.get('releaseDate', '') for s in json.load(f)}
+
+    metadata = {}
+    for filename in sorted(os.listdir(cards_dir)):
+        if not filename.endswith('.json'):
+            continue
+        with open(os.path.join(cards_dir, filename), 'r', encoding='utf-8') as f:
+            for card in json.load(f):
+                metadata[card['id']] = card_metadata(card, release_dates)
+    return metadata
@@ -1,13 +1,159 @@
+from itertools import islice
+
+import cv2
+import numpy as np
 from ultralytics import YOLO
 
+from tiling import cut_sides, make_tiles, merge_detections, paste_mask
+
+
+def remove_letterbox(masks, image_shape):
+    # masks come at the letterboxed inference size; crop off the padding so
+    # that the remaining area maps linearly onto the original image
+    h0, w0 = image_shape
+    mh, mw = masks.shape[1:]
+    gain = min(mh / h0, mw / w0)
+    pad_w, pad_h = (mw - round(w0 * gain)) / 2, (mh - round(h0 * gain)) / 2
+    top, left = int(round(pad_h - 0.1)), int(round(pad_w - 0.1))
+    bottom, right = mh - int(round(pad_h + 0.1)), mw - int(round(pad_w + 0.1))
+    return masks[:, top:bottom, left:right]
+
+
+class Detections:
+    '''
+    Detector output for one image, in the form the crop / embedding stage
+    consumes: the decoded RGB image, uint8 masks (0 or 255), xywh boxes
+    and one id per card
+    '''
+    def __init__(self, image, masks, bboxs, ids, source=None) -> None:
+        self.image = image
+        self.masks = masks
+        self.bboxs = bboxs
+        self.ids = ids
+        self.source = source
+
+    def __len__(self):
+        return len(self.bboxs)
+
+    @classmethod
+    def empty(cls, image, source=None):
+        return cls(image, np.zeros((0,) + image.shape[:2], dtype=np.uint8),
+                   np.zeros((0, 4), dtype=np.float32), [], source)
+
+    @classmethod
+    def from_result(cls, result, image, source=None, ids=None):
+        # convert an ultralytics segmentation result, empty when nothing was found
+        if result.masks is None or len(result.boxes) == 0:
+            return cls.empty(image, source)
+        masks = (result.masks.data.cpu().numpy() * 255).astype("uint8")
+        masks = remove_letterbox(masks, image.shape[:2])
+        bboxs = result.boxes.xywh.cpu().numpy()
+        if ids is None:
+            ids = list(range(len(bboxs)))
+        return cls(image, masks, bboxs, ids, source)
+
 
 class Detector:
-    def __init__(self, weights_path) -> None:
+    def __init__(self, weights_path, imgsz=640, tile_size=1280, tile_overlap=0.2) -> None:
         self.model = YOLO(weights_path)
         self.model.task = "segment"
+        self.imgsz = imgsz
+        # tiled mode (detect_tiled) for high resolution photos
+        self.tile_size = tile_size
+        self.tile_overlap = tile_overlap
 
     def detect_cards(self, source):
         results = self.model(source)
         return results
 
-    
+    def detect_batch(self, images, batch_size=8, imgsz=None):
+        '''
+        Runs detection over many images, batch_size images per forward pass
+        @param images: List or iterator of file paths and/or BGR numpy images
+        @param batch_size: Images per YOLO batch
+        @param imgsz: Inference size, fixed for every batch (defaults to self.imgsz)
+        return detections: Generator of Detections, one per input image, in order
+        '''
+        imgsz = imgsz or self.imgsz
+        images = iter(images)
+        while True:
+            chunk = list(islice(images, batch_size))
+            if not chunk:
+                return
+            sources = [item if isinstance(item, str) else None for item in chunk]
+            frames = [cv2.imread(item) if isinstance(item, str) else item for item in chunk]
+            for source, frame in zip(sources, frames):
+                if frame is None:
+                    raise FileNotFoundError(f"Could not read image {source}")
+
+            results = self.model.predict(frames, imgsz=imgsz, batch=len(frames), verbose=False)
+            for source, frame, result in zip(sources, frames, results):
+                image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                yield Detections.from_result(result, image, source)
+
+    def detect_tiled(self, image, tile_size=None, overlap=None, batch_size=8, imgsz=None,
+                     mask_size=1280):
+        '''
+        Detects cards on overlapping tiles of a large image and merges the
+        detections across tile seams
+        @param image: File path or BGR numpy image
+        @param tile_size: Tile side in image pixels (defaults to self.tile_size)
+        @param overlap: Fraction of overlap between neighbouring tiles (defaults to self.tile_overlap)
+        @param batch_size: Tiles per YOLO batch
+        @param mask_size: Long side of the shared canvas the merged masks are drawn on
+        return detections: Detections for the whole image, masks on the downscaled canvas
+        '''
+        source = image if isinstance(image, str) else None
+        frame = cv2.imread(image) if source else image
+        if frame is None:
+            raise FileNotFoundError(f"Could not read image {source}")
+        height, width = frame.shape[:2]
+        tiles = make_tiles(height, width, tile_size or self.tile_size,
+                           self.tile_overlap if overlap is None else overlap)
+
+        boxes, scores, pieces, cuts = [], [], [], []
+        for start in range(0, len(tiles), batch_size):
+            batch_tiles = tiles[start:start + batch_size]
+            crops = [frame[y0:y1, x0:x1] for x0, y0, x1, y1 in batch_tiles]
+            results = self.model.predict(crops, imgsz=imgsz or self.imgsz, batch=len(crops), verbose=False)
+            for tile, crop, result in zip(batch_tiles, crops, results):
+                if result.masks is None or len(result.boxes) == 0:
+                    continue
+                masks = remove_letterbox((result.masks.data.cpu().numpy() * 255).astype("uint8"),
+                                         crop.shape[:2])
+                offset = np.array([tile[0], tile[1], tile[0], tile[1]], dtype=np.float32)
+                for box, score, mask in zip(result.boxes.xyxy.cpu().numpy(),
+                                            result.boxes.conf.cpu().numpy(), masks):
+                    boxes.append(box + offset)
+                    scores.append(float(score))
+                    pieces.append((tile, mask))
+                    cuts.append(cut_sides(box + offset, tile, width, height))
+
+        image_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if not boxes:
+            return Detections.empty(image_rgb, source)
+
+        clusters = merge_detections(np.stack(boxes), scores, cuts=cuts)
+        scale = min(1.0, mask_size / max(height, width))
+        masks = np.zeros((len(clusters), round(height * scale), round(width * scale)), dtype=np.uint8)
+        bboxs = np.zeros((len(clusters), 4), dtype=np.float32)
+        for k, (box, members) in enumerate(clusters):
+            for i in members:
+                paste_mask(masks[k], pieces[i][1], pieces[i][0], scale)
+            bboxs[k] = [(box[0] + box[2]) / 2, (box[1] + box[3]) / 2, box[2] - box[0], box[3] - box[1]]
+        return Detections(image_rgb, masks, bboxs, list(range(len(clusters))), source)
+
+    def track(self, frame, imgsz=None):
+        '''
+        Detects and tracks cards in one video frame, keeping the tracker
+        state between calls so ids stay stable across consecutive frames
+        @param frame: BGR numpy image
+        return detections: Detections whose ids are track ids; cards the
+            tracker has not confirmed yet are left out
+        '''
+        result = self.model.track(frame, persist=True, imgsz=imgsz or self.imgsz, verbose=False)[0]
+        image = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        if result.boxes is None or result.boxes.id is None:
+            return Detections.empty(image)
+        ids = result.boxes.id.int().cpu().tolist()
+        return Detections.from_result(result, image, ids=ids)
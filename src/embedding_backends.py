@@ -0,0 +1,141 @@
+# Inference backends for the Retriever's embedding model
+#
+# Every backend takes a preprocessed (B, 3, H, W) float batch and returns the
+# (B, D) embeddings as a torch tensor, so the Retriever does not care which
+# runtime produced them:
+#   eager        torchvision ResNet18 with the trained weights
+#   torchscript  a traced module written by `export`
+#   onnx         ONNX Runtime (CPU) session over a model written by `export`
+# Thread counts are set explicitly instead of relying on runtime defaults.
+#
+# usage:
+#   python src/embedding_backends.py onnx res/detection_weights/resnet18_embeddings.onnx
+#   python src/embedding_backends.py torchscript res/detection_weights/resnet18_embeddings.ts
+
+import argparse
+
+import torch
+import torchvision.models as models
+
+EMBEDDING_WEIGHTS = "res/detection_weights/resnet18_embeddings.pth"
+INPUT_SIZE = 224
+
+
+def load_embedding_model(weights_path=EMBEDDING_WEIGHTS):
+    model = models.resnet18(pretrained=False)
+    model = torch.nn.Sequential(*list(model.children())[:-1])  # Remove the classification head
+    model.eval()
+    model.load_state_dict(torch.load(weights_path, map_location=torch.device('cpu')))
+    return model
+
+
+class EagerBackend:
+    name = "eager"
+
+    def __init__(self, weights_path=EMBEDDING_WEIGHTS, threads=None) -> None:
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = load_embedding_model(weights_path)
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.model(batch).flatten(1)
+
+
+class TorchScriptBackend:
+    name = "torchscript"
+
+    def __init__(self, path, threads=None) -> None:
+        if threads:
+            torch.set_num_threads(threads)
+        self.model = torch.jit.load(path, map_location=torch.device('cpu'))
+        self.model.eval()
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.model(batch).flatten(1)
+
+
+class OnnxBackend:
+    name = "onnx"
+
+    def __init__(self, path, threads=None) -> None:
+        try:
+            import onnxruntime as ort
+        except ImportError as e:
+            raise ImportError("The onnx backend needs onnxruntime, pip install onnxruntime") from e
+
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+            options.inter_op_num_threads = 1
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, batch):
+        (output,) = self.session.run(None, {self.input_name: batch.numpy()})
+        return torch.from_numpy(output).flatten(1)
+
+
+BACKENDS = {
+    "eager": EagerBackend,
+    "torchscript": TorchScriptBackend,
+    "onnx": OnnxBackend,
+}
+
+
+def load_backend(kind="eager", path=None, threads=None):
+    '''
+    Creates an embedding backend
+    @param kind: "eager", "torchscript" or "onnx"
+    @param path: Weights (eager, defaults to EMBEDDING_WEIGHTS) or exported model file
+    @param threads: Intra-op thread count, None keeps the runtime default
+    '''
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown embedding backend {kind}, expected one of {list(BACKENDS)}")
+    if kind == "eager":
+        return EagerBackend(path or EMBEDDING_WEIGHTS, threads)
+    if path is None:
+        raise ValueError(f"The {kind} backend needs the path of an exported model")
+    return BACKENDS[kind](path, threads)
+
+
+def export(kind, output_path, weights_path=EMBEDDING_WEIGHTS, input_size=INPUT_SIZE):
+    '''
+    Exports the eager model for the torchscript or onnx backend
+    @param kind: "torchscript" or "onnx"
+    @param output_path: File to write
+    @param input_size: Side of the square input the exported model is traced with
+    '''
+    model = torch.nn.Sequential(load_embedding_model(weights_path), torch.nn.Flatten(1)).eval()
+    example = torch.randn(1, 3, input_size, input_size)
+
+    if kind == "torchscript":
+        with torch.no_grad():
+            traced = torch.jit.trace(model, example)
+        traced = torch.jit.freeze(traced)
+        traced.save(output_path)
+    elif kind == "onnx":
+        torch.onnx.export(model, example, output_path, input_names=["input"], output_names=["embedding"],
+                          dynamic_axes={"input": {0: "batch"}, "embedding": {0: "batch"}},
+                          opset_version=17, dynamo=False)
+    else:
+        raise ValueError(f"Cannot export to {kind}, expected torchscript or onnx")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the embedding model for another backend")
+    parser.add_argument("kind", choices=["torchscript", "onnx"])
+    parser.add_argument("output", help="exported model file")
+    parser.add_argument("--weights", default=EMBEDDING_WEIGHTS, help="eager model weights")
+    parser.add_argument("--input-size", type=int, default=INPUT_SIZE,
+                        help="input resolution, must match the index (build_index.py --input-size)")
+    args = parser.parse_args()
+
+    export(args.kind, args.output, args.weights, args.input_size)
+    print(f"Exported {args.kind} embedding model to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# Crop-level embedding cache for the Retriever
+#
+# Rescanning the same binder page, or the same card showing up in several
+# consecutive camera shots, produces near-identical crops. Keying the cache by
+# a perceptual hash of the crop (rather than its raw bytes) lets those repeats
+# reuse the stored embedding and skip the model entirely. Lookups first try
+# the exact hash, then any cached hash within a small Hamming radius.
+
+from collections import OrderedDict
+
+import imagehash
+import numpy as np
+
+from hash_prefilter import hamming_distances, hash_to_int
+
+
+class EmbeddingCache:
+    def __init__(self, capacity=256, radius=4, hash_size=8) -> None:
+        '''
+        @param capacity: Maximum number of cached embeddings (LRU eviction)
+        @param radius: Largest Hamming distance still treated as the same crop, 0 = exact only
+        @param hash_size: phash size, the hash has hash_size ** 2 bits (at most 64)
+        '''
+        if hash_size > 8:
+            raise ValueError("hash_size must be at most 8 (64-bit hashes)")
+        self.capacity = capacity
+        self.radius = radius
+        self.hash_size = hash_size
+        self.entries = OrderedDict()  # hash -> embedding, least recently used first
+        self.stats = {"hits": 0, "near_hits": 0, "misses": 0, "evictions": 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def key(self, image):
+        # normalise the crop before hashing so colour mode does not change the key
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        return hash_to_int(imagehash.phash(image, hash_size=self.hash_size))
+
+    def get(self, key):
+        '''
+        Looks up an embedding by crop hash
+        @param key: Hash from key()
+        return vector: The cached embedding, or None on a miss
+        '''
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return self.entries[key]
+
+        if self.radius and self.entries:
+            keys = np.fromiter(self.entries.keys(), dtype=np.uint64, count=len(self.entries))
+            dist = hamming_distances(key, keys)
+            closest = int(dist.argmin())
+            if dist[closest] <= self.radius:
+                match = int(keys[closest])
+                self.entries.move_to_end(match)
+                self.stats["near_hits"] += 1
+                return self.entries[match]
+
+        self.stats["misses"] += 1
+        return None
+
+    def put(self, key, vector):
+        self.entries[key] = vector
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def hit_rate(self):
+        hits = self.stats["hits"] + self.stats["near_hits"]
+        total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+    def clear(self):
+        self.entries.clear()
@@ -0,0 +1,295 @@
+# On-disk format for the reference embeddings used by the Retriever
+#
+# layout (little endian):
+#   header      magic, version, count, dim, table offset/length, data offset
+#   card table  utf-8 JSON object, {"card_ids": [...], "input_size": ...} plus,
+#               optionally, per-card "metadata" columns and the row range of
+#               every set ("partitions")
+#   embeddings  count x dim float32, L2-normalised, 64-byte aligned
+#   [codes]     optional compressed copy (float16 or int8) of the embeddings
+#   [scales]    float32 int8 scales, one per vector or one per dimension
+#
+# The blocks are memory-mapped on load, so startup does not unpickle anything
+# and several worker processes share the same page-cache copy. When a
+# compressed copy is present the Retriever scans only that block and pages in
+# float32 rows just for the shortlisted candidates it re-ranks.
+
+import argparse
+import json
+import re
+import struct
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from embedding_backends import INPUT_SIZE
+from card_metadata import METADATA_FIELDS, load_card_metadata, set_id_from_card_id
+
+MAGIC = b"TCGEMBIX"
+VERSION = 1
+HEADER = struct.Struct("<8sIQIQQQ")
+ALIGNMENT = 64
+STORAGE_DTYPES = {"float16": "<f2", "int8": "i1"}
+SCALE_MODES = ("vector", "dimension")
+
+
+def parse_card_id(key):
+    # legacy keys are the image paths the embeddings were generated from,
+    # e.g. "...\\images\\base1-4.png" -> "base1-4"
+    match = re.search(r'\\([^\\]+)\.png', key)
+    if match:
+        return match.group(1)
+    return key
+
+
+def build_embedding_matrix(dataset):
+    # stack the per-card tensors into one contiguous, L2-normalised float32 matrix
+    card_ids = [parse_card_id(k) for k in dataset.keys()]
+    matrix = torch.stack([v.flatten().float() for v in dataset.values()])
+    matrix = F.normalize(matrix, dim=1).contiguous()
+    return card_ids, matrix
+
+
+def load_index(path):
+    # legacy .pt dicts are converted in memory, anything else is an index file
+    if path.endswith(".pt"):
+        return EmbeddingIndex.from_torch_dataset(path)
+    return EmbeddingIndex.load(path)
+
+
+def quantize(embeddings, dtype, scale_mode="vector"):
+    '''
+    Compresses a (N, D) float32 matrix
+    @param dtype: "float16" or "int8"
+    @param scale_mode: For int8, a symmetric scale per "vector" (row) or per "dimension" (column)
+    return codes, scales: The compressed numpy matrix and the float32 int8 scales (None for float16)
+    '''
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype == "float16":
+        return embeddings.astype("<f2"), None
+    if dtype != "int8":
+        raise ValueError(f"Unsupported storage dtype {dtype}, expected one of {list(STORAGE_DTYPES)}")
+    if scale_mode not in SCALE_MODES:
+        raise ValueError(f"Unsupported scale mode {scale_mode}, expected one of {SCALE_MODES}")
+
+    axis = 1 if scale_mode == "vector" else 0
+    scales = np.abs(embeddings).max(axis=axis) / 127
+    scales[scales == 0] = 1
+    scales = scales.astype(np.float32)
+    divisor = scales[:, None] if scale_mode == "vector" else scales[None, :]
+    codes = np.clip(np.rint(embeddings / divisor), -127, 127).astype(np.int8)
+    return codes, scales
+
+
+class QuantizedEmbeddings:
+    def __init__(self, codes, scales=None, scale_mode=None, chunk_rows=8192) -> None:
+        self.codes = codes
+        self.scales = scales
+        self.scale_mode = scale_mode
+        self.chunk_rows = chunk_rows
+
+    @property
+    def nbytes(self):
+        scales = 0 if self.scales is None else self.scales.nbytes
+        return self.codes.nbytes + scales
+
+    def scores(self, queries):
+        # approximate (B, N) cosine scores, decompressing one chunk of rows at a time
+        queries = queries.float()
+        if self.scale_mode == "dimension":
+            queries = queries * torch.from_numpy(self.scales)
+
+        scores = []
+        for start in range(0, self.codes.shape[0], self.chunk_rows):
+            chunk = torch.from_numpy(np.asarray(self.codes[start:start + self.chunk_rows])).float()
+            chunk_scores = queries @ chunk.T
+            if self.scale_mode == "vector":
+                chunk_scores *= torch.from_numpy(self.scales[start:start + self.chunk_rows])
+            scores.append(chunk_scores)
+        return torch.cat(scores, dim=1)
+
+    def search(self, queries, full, n=5, rerank=32):
+        '''
+        Scans the compressed vectors, then re-ranks the best max(n, rerank)
+        candidates of each query exactly against the full-precision matrix
+        @param queries: (B, D) L2-normalised query vectors
+        @param full: The (N, D) float32 (memory-mapped) embeddings
+        return rows: One list of row ids per query, best first
+        '''
+        scores = self.scores(queries)
+        shortlist = torch.topk(scores, min(max(n, rerank), scores.shape[1]), dim=1).indices
+
+        candidates = full[shortlist.flatten()].float().reshape(*shortlist.shape, -1)
+        exact = torch.einsum("brd,bd->br", candidates, queries.float())
+        top = torch.topk(exact, min(n, exact.shape[1]), dim=1).indices
+        return shortlist.gather(1, top).tolist()
+
+
+class EmbeddingIndex:
+    def __init__(self, card_ids, embeddings, quantized=None, metadata=None, partitions=None,
+                 input_size=INPUT_SIZE) -> None:
+        self.card_ids = list(card_ids)
+        self.embeddings = embeddings
+        self.quantized = quantized
+        # {field: [value per row]} and {set id: [start row, end row)}
+        self.metadata = metadata
+        self.partitions = partitions
+        # side of the square images the embeddings were computed from
+        self.input_size = input_size
+
+    def attach_metadata(self, cards):
+        '''
+        Sets the metadata columns from per-card metadata
+        @param cards: {card id: {"set_id", "supertype", "release_date"}}, see card_metadata.py
+        '''
+        columns = {field: [] for field in METADATA_FIELDS}
+        for card_id in self.card_ids:
+            card = cards.get(card_id, {})
+            columns["set_id"].append(card.get("set_id") or set_id_from_card_id(card_id))
+            columns["supertype"].append(card.get("supertype", ""))
+            columns["release_date"].append(card.get("release_date", ""))
+        self.metadata = columns
+
+    def __len__(self):
+        return len(self.card_ids)
+
+    @property
+    def dim(self):
+        return self.embeddings.shape[1]
+
+    def save(self, path, storage=None, scale_mode="vector"):
+        '''
+        Writes the index to disk. Embeddings are expected to already be
+        L2-normalised (see build_embedding_matrix).
+        @param path: Destination file
+        @param storage: Also store a "float16" or "int8" copy to scan in compressed form
+        @param scale_mode: Scale granularity for int8 storage, "vector" or "dimension"
+        '''
+        embeddings = np.ascontiguousarray(
+            torch.as_tensor(self.embeddings).numpy(), dtype="<f4")
+        table = {"card_ids": self.card_ids, "input_size": self.input_size}
+
+        if self.metadata is not None:
+            # group the rows by set so that a set filter selects contiguous partitions
+            set_ids = self.metadata["set_id"]
+            order = sorted(range(len(set_ids)), key=lambda i: set_ids[i])
+            embeddings = np.ascontiguousarray(embeddings[order])
+            table["card_ids"] = [self.card_ids[i] for i in order]
+            table["metadata"] = {field: [values[i] for i in order]
+                                 for field, values in self.metadata.items()}
+            partitions = {}
+            for row, set_id in enumerate(table["metadata"]["set_id"]):
+                partitions.setdefault(set_id, [row, row])[1] = row + 1
+            table["partitions"] = partitions
+
+        # compressed blocks follow the float32 block, offsets are relative to its start
+        blocks = [embeddings]
+        if storage is not None:
+            codes, scales = quantize(embeddings, storage, scale_mode)
+            codes_offset = _align(embeddings.nbytes)
+            table["storage"] = {"dtype": storage, "codes_offset": codes_offset}
+            blocks.append(codes)
+            if scales is not None:
+                table["storage"]["scale_mode"] = scale_mode
+                table["storage"]["scales_offset"] = _align(codes_offset + codes.nbytes)
+                blocks.append(scales)
+
+        table = json.dumps(table).encode("utf-8")
+        table_offset = HEADER.size
+        data_offset = _align(table_offset + len(table))
+
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.card_ids), embeddings.shape[1],
+                                table_offset, len(table), data_offset))
+            f.write(table)
+            f.write(b"\0" * (data_offset - table_offset - len(table)))
+            for block in blocks:
+                f.write(b"\0" * (_align(f.tell()) - f.tell()))
+                f.write(block.tobytes())
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Opens an index written by save(). The embedding blocks are mapped
+        copy-on-write rather than read into memory.
+        @param path: Index file
+        return index: EmbeddingIndex whose embeddings are a (N, D) float32 tensor
+        '''
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                raise ValueError(f"{path} is not an embedding index (truncated header)")
+            magic, version, count, dim, table_offset, table_length, data_offset = HEADER.unpack(header)
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an embedding index")
+            if version != VERSION:
+                raise ValueError(f"Unsupported embedding index version {version} in {path}")
+
+            f.seek(table_offset)
+            table = json.loads(f.read(table_length).decode("utf-8"))
+
+        metadata, partitions = table.get("metadata"), table.get("partitions")
+        input_size = table.get("input_size", INPUT_SIZE)
+        if count == 0:
+            return cls(table["card_ids"], torch.empty((0, dim), dtype=torch.float32),
+                       metadata=metadata, partitions=partitions, input_size=input_size)
+
+        block = np.memmap(path, dtype="<f4", mode="c", offset=data_offset, shape=(count, dim))
+
+        quantized = None
+        storage = table.get("storage")
+        if storage is not None:
+            codes = np.memmap(path, dtype=STORAGE_DTYPES[storage["dtype"]], mode="c",
+                              offset=data_offset + storage["codes_offset"], shape=(count, dim))
+            scales = None
+            scale_mode = storage.get("scale_mode")
+            if scale_mode is not None:
+                scales = np.memmap(path, dtype="<f4", mode="c",
+                                   offset=data_offset + storage["scales_offset"],
+                                   shape=(count if scale_mode == "vector" else dim,))
+            quantized = QuantizedEmbeddings(codes, scales, scale_mode)
+
+        return cls(table["card_ids"], torch.from_numpy(block), quantized, metadata, partitions, input_size)
+
+    @classmethod
+    def from_torch_dataset(cls, embeddings_path):
+        '''
+        Builds an index from a legacy torch.save'd {image path: tensor} dict
+        @param embeddings_path: The .pt file
+        '''
+        dataset = torch.load(embeddings_path)
+        # the embedding notebook wraps the dict as {"model": ..., "embeddings": {...}}
+        if "embeddings" in dataset and isinstance(dataset["embeddings"], dict):
+            dataset = dataset["embeddings"]
+        card_ids, embeddings = build_embedding_matrix(dataset)
+        return cls(card_ids, embeddings)
+
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert a legacy .pt embeddings dict into a memory-mappable index")
+    parser.add_argument("source", help="torch.save'd {image path: embedding} dict, or an existing index")
+    parser.add_argument("destination", help="index file to write")
+    parser.add_argument("--storage", choices=list(STORAGE_DTYPES), default=None,
+                        help="also store a compressed copy that the retriever scans")
+    parser.add_argument("--scale-mode", choices=SCALE_MODES, default="vector",
+                        help="int8 scale granularity")
+    parser.add_argument("--cards", default=None,
+                        help="folder of bulk card JSON dumps, attaches set/supertype/release date metadata")
+    parser.add_argument("--sets", default=None, help="JSON list of sets providing release dates")
+    args = parser.parse_args()
+
+    index = load_index(args.source)
+    if args.cards:
+        index.attach_metadata(load_card_metadata(args.cards, args.sets))
+    index.save(args.destination, storage=args.storage, scale_mode=args.scale_mode)
+    print(f"Wrote {len(index)} embeddings of dim {index.dim} to {args.destination}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,10 +8,10 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Database methods
 from backend.db_methods import get_card, populate_tables, retrieve_card_pricing_table, retrieve_pokemon_information_table, delete_card
-# Model
-from model import Model
+# Model, loaded once per server process and warmed up in the background
+import model_registry
 
-model = Model()
+model_registry.start_warmup()
 
 st.title('Pokemon Trading Card Scanner')
 scan_tab, collection_tab = st.tabs(['Scan', 'Collection'])
@@ -36,14 +36,17 @@ def scan_card(image):
         temp_image_path = temp_image.name
 
     # Call model and save results
-    model.process_image(temp_image_path)
-    st.session_state.model_results = model.results
-    st.session_state.model_img = model.img
+    model = model_registry.get_model()
+    with model_registry.model_lock:
+        model.process_image(temp_image_path)
+        results = model.results
+        st.session_state.model_results = results
+        st.session_state.model_img = model.img
     
     # Save each card name and id
     names = []
     ids = []
-    for card, data in model.results.items():
+    for card, data in results.items():
         names.append(data.name)
         ids.append(data.id)
     st.session_state.scanned_name = names
@@ -77,6 +80,8 @@ def scan_from_file():
 # Scan tab
 with scan_tab:
     st.header('Scan a new card')
+    if not model_registry.is_ready():
+        st.caption('Loading models in the background, the first scan may take a moment.')
 
     # Buttons to scan image
     col1, col2, col3 = st.columns([5, 5, 10])
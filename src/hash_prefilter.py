@@ -0,0 +1,117 @@
+# Perceptual-hash prefilter for the Retriever
+#
+# Hamming distances between 64-bit image hashes are far cheaper than a ResNet
+# forward pass plus a cosine scan. For every crop the prefilter either answers
+# directly (the best hash match is close and clearly ahead of the runner-up)
+# or returns a shortlist of card ids for the embedding search to re-rank.
+# The hash databases use the format written by image-hashing-trial/hash_images.py,
+# a JSON object of {hex hash: card id} per hash method.
+
+import json
+
+import imagehash
+import numpy as np
+
+HASH_FUNCTIONS = {
+    'phash': imagehash.phash,
+    'dhash': imagehash.dhash,
+    'average_hash': imagehash.average_hash,
+    'whash': imagehash.whash,
+}
+
+# same weighting as image-hashing-trial/find_image_from_hash.py
+DEFAULT_WEIGHTS = {
+    'phash': 1.0,
+    'dhash': 0.3,
+    'average_hash': 0.6,
+    'whash': 0.2,
+}
+
+HASH_BITS = 64
+
+# number of set bits in every byte value
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def hamming_distances(query, hashes):
+    # bit differences between one uint64 hash and an array of them
+    diff = np.bitwise_xor(hashes, np.uint64(query))
+    return _POPCOUNT[diff.view(np.uint8)].reshape(-1, 8).sum(1)
+
+
+def hash_to_int(hash_value):
+    return int(str(hash_value), 16)
+
+
+class HashPrefilter:
+    def __init__(self, hash_files, hash_weights=None, accept_distance=4.0, accept_margin=4.0,
+                 shortlist_size=100) -> None:
+        '''
+        @param hash_files: {hash method: path of its JSON database}
+        @param hash_weights: Weight of each hash method in the combined distance
+        @param accept_distance: Answer from the hashes alone when the best weighted
+            distance is at most this
+        @param accept_margin: ...and the runner-up is at least this much further away
+        @param shortlist_size: Number of card ids handed to the embedding re-rank otherwise
+        '''
+        weights = hash_weights or DEFAULT_WEIGHTS
+        self.hash_weights = {k: weights[k] for k in hash_files}
+        self.accept_distance = accept_distance
+        self.accept_margin = accept_margin
+        self.shortlist_size = shortlist_size
+        self.stats = {"accepted": 0, "shortlisted": 0}
+
+        databases = {}
+        for hash_type, file_path in hash_files.items():
+            with open(file_path, 'r', encoding='utf-8') as f:
+                databases[hash_type] = json.load(f)
+
+        # one row per card, one column per hash method; cards missing from a
+        # method's database get the maximum distance for it
+        self.card_ids = sorted({card_id for db in databases.values() for card_id in db.values()})
+        rows = {card_id: i for i, card_id in enumerate(self.card_ids)}
+        self.hashes = {}
+        self.present = {}
+        for hash_type, db in databases.items():
+            hashes = np.zeros(len(self.card_ids), dtype=np.uint64)
+            present = np.zeros(len(self.card_ids), dtype=bool)
+            for hex_hash, card_id in db.items():
+                hashes[rows[card_id]] = int(hex_hash, 16)
+                present[rows[card_id]] = True
+            self.hashes[hash_type] = hashes
+            self.present[hash_type] = present
+
+    def distances(self, image):
+        # weighted hamming distance from the image to every card
+        total = np.zeros(len(self.card_ids), dtype=np.float32)
+        for hash_type, weight in self.hash_weights.items():
+            query = hash_to_int(HASH_FUNCTIONS[hash_type](image))
+            dist = hamming_distances(query, self.hashes[hash_type]).astype(np.float32)
+            dist[~self.present[hash_type]] = HASH_BITS
+            total += weight * dist
+        return total / sum(self.hash_weights.values())
+
+    def check(self, image, n=5):
+        '''
+        Runs the prefilter on one crop
+        @param image: PIL image of the crop
+        return accepted, card_ids: (True, top n ids) when the hashes are confident,
+            otherwise (False, shortlist of candidate ids for the embedding search)
+        '''
+        dist = self.distances(image)
+        k = min(max(n, self.shortlist_size), len(dist))
+        order = np.argpartition(dist, k - 1)[:k]
+        order = order[np.argsort(dist[order], kind="stable")]
+
+        best = dist[order[0]]
+        runner_up = dist[order[1]] if len(order) > 1 else HASH_BITS
+        if best <= self.accept_distance and runner_up - best >= self.accept_margin:
+            self.stats["accepted"] += 1
+            return True, [self.card_ids[i] for i in order[:n]]
+
+        self.stats["shortlisted"] += 1
+        return False, [self.card_ids[i] for i in order]
+
+    def cheap_path_rate(self):
+        total = self.stats["accepted"] + self.stats["shortlisted"]
+        return self.stats["accepted"] / total if total else 0.0
@@ -0,0 +1,225 @@
+# Persistent cache of API responses
+#
+# Card lookups (CardLookup, db_methods.get_card) go through this SQLite
+# backed cache, so a restarted app, the Streamlit reruns and several worker
+# processes all reuse earlier fetches. Responses are kept per URL with the
+# time they were fetched. Card metadata hardly ever changes while prices do,
+# so callers say what they need and each kind has its own TTL:
+#   fresh     age < ttl                  served from the cache
+#   stale     age < ttl + stale_ttl      served from the cache, and re-fetched
+#                                        in the background (stale-while-revalidate)
+#   expired   older                      fetched before returning
+# A failed fetch still falls back to any cached copy. The total size of the
+# stored bodies is bounded, the least recently used responses are evicted.
+# Hits only read: access times are queued and written in batches, and the
+# total size is a running figure kept by triggers, not a scan per store.
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import model_registry
+
+# anchored to the repository, so the app, the services and the tools started
+# from any directory share one cache; HTTP_CACHE_PATH overrides it
+CACHE_PATH = os.getenv("HTTP_CACHE_PATH", os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", ".cache", "http_responses.sqlite")))
+
+# access times are written in batches, not on every hit
+ACCESS_FLUSH_COUNT = 64
+ACCESS_FLUSH_SECONDS = 30.0
+
+METADATA_TTL = 30 * 24 * 3600
+PRICE_TTL = 24 * 3600
+STALE_TTL = 7 * 24 * 3600
+
+
+class ResponseCache:
+    def __init__(self, path=CACHE_PATH, metadata_ttl=METADATA_TTL, price_ttl=PRICE_TTL,
+                 stale_ttl=STALE_TTL, max_bytes=64 * 2 ** 20) -> None:
+        '''
+        @param path: SQLite file, shared by every process using the same path
+        @param metadata_ttl: Seconds a response is fresh for callers that need card metadata only
+        @param price_ttl: Seconds a response is fresh for callers that need current prices
+        @param stale_ttl: Seconds past the TTL a response is still served while it is re-fetched
+        @param max_bytes: Bound on the total size of the stored response bodies
+        '''
+        self.path = path
+        self.ttls = {"metadata": metadata_ttl, "prices": price_ttl}
+        self.stale_ttl = stale_ttl
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.revalidating = set()
+        self.accessed = {}  # url -> last access time not written yet
+        self.flushed_at = time.monotonic()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "revalidations": 0,
+                      "errors": 0, "evictions": 0}
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    url TEXT PRIMARY KEY,
+                    body TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    fetched_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )""")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed_at)")
+            # running total of the body sizes, kept by triggers so that every
+            # process writing the file sees the same figure without a SUM scan
+            conn.execute("CREATE TABLE IF NOT EXISTS totals (id INTEGER PRIMARY KEY CHECK (id = 1), size INTEGER NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO totals SELECT 1, COALESCE(SUM(size), 0) FROM responses")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses
+                BEGIN UPDATE totals SET size = size + NEW.size WHERE id = 1; END""")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses
+                BEGIN UPDATE totals SET size = size + NEW.size - OLD.size WHERE id = 1; END""")
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses
+                BEGIN UPDATE totals SET size = size - OLD.size WHERE id = 1; END""")
+
+    def connection(self):
+        # one connection per thread; WAL lets readers and a writer from other processes overlap
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def count(self, stat):
+        with self.lock:
+            self.stats[stat] += 1
+
+    def lookup(self, url):
+        # (parsed body, age in seconds) of the cached response, or None; a read only,
+        # the access time is queued and written with the next batch
+        conn = self.connection()
+        row = conn.execute("SELECT body, fetched_at FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        with self.lock:
+            self.accessed[url] = now
+            due = len(self.accessed) >= ACCESS_FLUSH_COUNT \
+                or time.monotonic() - self.flushed_at >= ACCESS_FLUSH_SECONDS
+        if due:
+            self.flush_access_times()
+        return json.loads(row[0]), now - row[1]
+
+    def flush_access_times(self):
+        # writes the queued access times in one transaction
+        with self.lock:
+            accessed, self.accessed = self.accessed, {}
+            self.flushed_at = time.monotonic()
+        if accessed:
+            with self.connection() as conn:
+                conn.executemany("UPDATE responses SET accessed_at = MAX(accessed_at, ?) WHERE url = ?",
+                                 [(at, url) for url, at in accessed.items()])
+
+    def store(self, url, value):
+        body = json.dumps(value)
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            # an upsert rather than INSERT OR REPLACE, whose implicit delete skips the triggers
+            conn.execute("INSERT INTO responses (url, body, size, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?) "
+                         "ON CONFLICT (url) DO UPDATE SET body = excluded.body, size = excluded.size, "
+                         "fetched_at = excluded.fetched_at, accessed_at = excluded.accessed_at",
+                         (url, body, len(body), now, now))
+        self.evict()
+
+    def size(self):
+        # total size of the stored bodies
+        return self.connection().execute("SELECT size FROM totals WHERE id = 1").fetchone()[0]
+
+    def evict(self):
+        # drop least recently used responses until the bodies fit in max_bytes
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+        # recency decides, so the queued access times go in first
+        self.flush_access_times()
+        evicted = 0
+        conn = self.connection()
+        with conn:
+            for url, size in conn.execute("SELECT url, size FROM responses ORDER BY accessed_at").fetchall():
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM responses WHERE url = ?", (url,))
+                total -= size
+                evicted += 1
+        with self.lock:
+            self.stats["evictions"] += evicted
+
+    def get_json(self, url, fetch, kind="metadata"):
+        '''
+        Returns the JSON response for url, from the cache when it is fresh enough
+        @param url: Cache key, the requested URL
+        @param fetch: Zero-argument callable doing the request, returns the parsed JSON
+            and raises when the request failed (failures are not cached)
+        @param kind: "metadata" or "prices", selects the TTL
+        return value: The parsed JSON
+        '''
+        cached = self.lookup(url)
+        if cached is not None:
+            value, age = cached
+            ttl = self.ttls[kind]
+            if age < ttl:
+                self.count("hits")
+                return value
+            if age < ttl + self.stale_ttl:
+                self.count("stale_hits")
+                self.revalidate(url, fetch)
+                return value
+
+        self.count("misses")
+        try:
+            value = fetch()
+        except Exception:
+            if cached is None:
+                raise
+            # stale-if-error: better an old response than none
+            self.count("errors")
+            logging.warning(f"Fetching {url} failed, serving the cached response")
+            return cached[0]
+        self.store(url, value)
+        return value
+
+    def revalidate(self, url, fetch):
+        # re-fetch in the background, at most once at a time per URL
+        with self.lock:
+            if url in self.revalidating:
+                return
+            self.revalidating.add(url)
+
+        def run():
+            try:
+                self.store(url, fetch())
+                self.count("revalidations")
+            except Exception as e:
+                self.count("errors")
+                logging.warning(f"Revalidating {url} failed: {e}")
+            finally:
+                with self.lock:
+                    self.revalidating.discard(url)
+
+        threading.Thread(target=run, name="http-cache-revalidate", daemon=True).start()
+
+    def clear(self):
+        with self.lock:
+            self.accessed = {}
+        with self.connection() as conn:
+            conn.execute("DELETE FROM responses")
+
+
+def get_response_cache(path=CACHE_PATH):
+    # the process-wide response cache, processes share it through the SQLite file
+    return model_registry.get_resource("http_cache", lambda: ResponseCache(path))
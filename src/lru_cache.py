@@ -0,0 +1,163 @@
+# Thread-safe in-memory LRU / TTL cache
+#
+# Replaces FIFOCache: hot keys stay cached (least recently *used* entries are
+# evicted, not the oldest inserted), entries can expire after a TTL, and the
+# cache is bounded by item count and/or by the approximate size of the
+# values. One lock guards every operation, so instances can be shared by
+# the pipeline, lookup and server threads. memoize() wraps a function with
+# its own cache.
+
+import functools
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+def approx_size(value, depth=3):
+    '''
+    Rough size of a value in bytes, for byte-bounded caches
+    @param depth: How deep containers and object attributes are followed
+    '''
+    if hasattr(value, "nbytes"):                  # numpy arrays
+        return int(value.nbytes)
+    if hasattr(value, "element_size") and hasattr(value, "nelement"):  # torch tensors
+        return value.element_size() * value.nelement()
+    size = sys.getsizeof(value)
+    if depth <= 0 or isinstance(value, (str, bytes, bytearray)):
+        return size
+    if isinstance(value, dict):
+        return size + sum(approx_size(k, depth - 1) + approx_size(v, depth - 1) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(approx_size(v, depth - 1) for v in value)
+    if hasattr(value, "__dict__"):                # plain objects / dataclasses such as Card
+        return size + approx_size(vars(value), depth - 1)
+    return size
+
+
+class LRUCache:
+    def __init__(self, max_items=128, max_bytes=None, ttl=None, sizeof=approx_size) -> None:
+        '''
+        @param max_items: Maximum number of entries, None for no count bound
+        @param max_bytes: Maximum total approximate size of the values, None for no size bound
+        @param ttl: Seconds an entry stays valid, None never expires
+        @param sizeof: Callable returning the size of a value, used with max_bytes
+        '''
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.entries = OrderedDict()  # key -> (value, size, expires at), least recently used first
+        self.nbytes = 0
+        self.lock = threading.RLock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        # presence check only, does not count as a use or a hit
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and not self._expired(entry)
+
+    def _expired(self, entry):
+        return entry[2] is not None and entry[2] <= time.monotonic()
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.nbytes -= size
+
+    def get(self, key, default=None):
+        '''
+        Looks up a key, refreshing its recency
+        return value: The cached value, or default on a miss or when it expired
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self._expired(entry):
+                self._remove(key)
+                self.stats["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.stats["misses"] += 1
+                return default
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[0]
+
+    def put(self, key, value, ttl=_MISSING):
+        '''
+        Stores a value, evicting least recently used entries past the bounds
+        @param ttl: Overrides the cache's TTL for this entry
+        '''
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        ttl = self.ttl if ttl is _MISSING else ttl
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                # larger than the whole cache, not worth evicting everything for
+                self.stats["evictions"] += 1
+                return
+            self.entries[key] = (value, size, expires)
+            self.nbytes += size
+            while self.entries and ((self.max_items is not None and len(self.entries) > self.max_items)
+                                    or (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                self._remove(next(iter(self.entries)))
+                self.stats["evictions"] += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value = self.entries[key][0]
+            self._remove(key)
+            return value
+
+    def items(self):
+        # snapshot of the live (key, value) pairs, least recently used first
+        with self.lock:
+            return [(key, entry[0]) for key, entry in self.entries.items() if not self._expired(entry)]
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+
+    def __repr__(self):
+        return (f"LRUCache({len(self)} items, {self.nbytes} bytes, hits={self.stats['hits']}, "
+                f"misses={self.stats['misses']}, evictions={self.stats['evictions']})")
+
+
+def memoize(max_items=128, max_bytes=None, ttl=None, key=None):
+    '''
+    Decorator caching a function's results in an LRUCache
+    @param key: Callable building the cache key from the call's arguments, needed when
+        they are not hashable; defaults to the positional and keyword arguments
+    The cache is exposed as wrapper.cache (e.g. wrapper.cache.clear() to invalidate).
+    Exceptions are not cached.
+    '''
+    def decorator(fn):
+        cache = LRUCache(max_items, max_bytes, ttl)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            cache_key = key(*args, **kwargs) if key else (args, tuple(sorted(kwargs.items())))
+            value = cache.get(cache_key, _MISSING)
+            if value is _MISSING:
+                value = fn(*args, **kwargs)
+                cache.put(cache_key, value)
+            return value
+
+        wrapper.cache = cache
+        return wrapper
+    return decorator
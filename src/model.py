@@ -1,10 +1,18 @@
 import cv2
 import asyncio
+import os
 from detector import Detector
 from retriever import Retriever
+from hash_prefilter import HashPrefilter
+from embedding_cache import EmbeddingCache
+from embedding_backends import load_backend
+from binder import DEFAULT_LAYOUTS, detect_grid, slice_pockets
+from rectify import rectify_card
+from card_lookup import CardLookup
+from card_catalog import get_catalog
+from http_cache import get_response_cache
 from PIL import Image
 import numpy as np
-from pokemontcgsdk import Card
 from pokemontcgsdk import RestClient
 import cv2
 import numpy as np
@@ -13,9 +21,34 @@ from PIL import Image
 RestClient.configure('c0a13e31-4371-413c-8f1f-264697acc48e')  # my API key
 
 class Model:
-    def __init__(self):
-        self.det = Detector("res\\detection_weights\\yolo11n_seg_best_10epochs.onnx")
-        self.ret = Retriever("res\\classification_embeddings\\Resnet18_embeddings.pt")
+    def __init__(self, hash_files=None, embedding_cache_size=256, embedding_backend="eager",
+                 embedding_model_path=None, threads=None, rectify=False, index_path=None,
+                 detector_path=None):
+        # hash_files ({hash method: JSON database}) enables the cascaded
+        # perceptual-hash prefilter in front of the embedding search
+        prefilter = HashPrefilter(hash_files) if hash_files else None
+        # repeated crops (rescans, consecutive camera shots) reuse their embedding
+        cache = EmbeddingCache(embedding_cache_size) if embedding_cache_size else None
+        # embedding runtime: "eager", "torchscript" or "onnx" (see embedding_backends.py)
+        backend = load_backend(embedding_backend, embedding_model_path, threads)
+        # detector_path / index_path select other detector weights and another
+        # index, e.g. one built with --input-size 160
+        self.det = Detector(detector_path or "res\\detection_weights\\yolo11n_seg_best_10epochs.onnx")
+        # the default index falls back to the legacy .pt embeddings (converted in
+        # memory on load) on checkouts where the .idx was never built
+        if index_path is None:
+            index_path = "res\\classification_embeddings\\Resnet18_embeddings.idx"
+            if not os.path.exists(index_path):
+                index_path = "res\\classification_embeddings\\Resnet18_embeddings.pt"
+        self.ret = Retriever(index_path, prefilter=prefilter, embedding_cache=cache, backend=backend)
+        # rectify warps each card upright to the embedder input (see rectify.py)
+        # instead of cropping its axis-aligned bbox
+        self.rectify = rectify
+        # card metadata comes from the local catalog of bulk set dumps; misses
+        # go to the API, concurrently, with timeouts and retries (see card_lookup.py),
+        # through the on-disk response cache
+        self.lookup = CardLookup(catalog=get_catalog(), cache=get_response_cache())
+        self.filters = None
 
     def get_bbox_corner(self, bbox, img):
         x, y, w, h = bbox
@@ -33,84 +66,177 @@ class Model:
         return x_min, y_min, x_max, y_max
 
 
-    def get_segmented_card(self, mask, bbox, img):
-        resized_mask = cv2.resize(
-            mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
-
-        # get masked pixels
-        cutout = resized_mask[..., None]*img
-
+    def get_segmented_card(self, mask, bbox, img, corners=None):
         # Get bounding box coordinates (x, y, width, height, conf, label)
-        x_min, y_min, x_max, y_max = self.get_bbox_corner(bbox, img)
-
-        # Crop to bounding box
-        cropped_cutout = cutout[y_min:y_max, x_min:x_max]
+        x_min, y_min, x_max, y_max = corners or self.get_bbox_corner(bbox, img)
+
+        # upsample only the part of the mask under the bbox: nearest-neighbour
+        # lookup of the mask pixel for every ROI pixel, with the indices computed
+        # the way cv2.resize(INTER_NEAREST) does (floor(x * (1 / (dst / src))), in
+        # double), so the result matches resizing the whole mask, then cropping
+        sy = 1.0 / (img.shape[0] / mask.shape[0])
+        sx = 1.0 / (img.shape[1] / mask.shape[1])
+        rows = np.minimum(np.floor(np.arange(y_min, y_max) * sy).astype(np.intp), mask.shape[0] - 1)
+        cols = np.minimum(np.floor(np.arange(x_min, x_max) * sx).astype(np.intp), mask.shape[1] - 1)
+        roi_mask = mask[rows[:, None], cols]
+
+        # get masked pixels, uint8 on the ROI view only
+        roi = img[y_min:y_max, x_min:x_max]
+        cutout = cv2.bitwise_and(roi, roi, mask=roi_mask)
 
         # Convert to PIL image
-        cropped_cutout = Image.fromarray((cropped_cutout * 255).astype(np.uint8))
+        return Image.fromarray(cutout)
 
-        return cropped_cutout
 
+    def get_rectified_card(self, mask, bbox, img, corners=None):
+        # upright card warped straight to the embedder's input size, falls back
+        # to the masked bbox crop when no quadrilateral fits the mask
+        card = rectify_card(img, mask, self.ret.input_size)
+        if card is None:
+            return self.get_segmented_card(mask, bbox, img, corners)
+        return Image.fromarray(card)
 
-    def process_card(self, mask, bbox, track_id):
-        x_min, y_min, x_max, y_max = self.get_bbox_corner(bbox, self.img)
 
-        # Convert to PIL image
-        cropped_cutout = self.get_segmented_card(mask, bbox, self.img)
-
-        # Get card id
-        matches = self.ret.get_card_id(cropped_cutout)
-        card_id = matches[0]
-        try:
-            card = Card.find(card_id)
-        except:
-            print("Card not found")
+    def crop_card(self, mask, bbox, img, corners=None):
+        if self.rectify:
+            return self.get_rectified_card(mask, bbox, img, corners)
+        return self.get_segmented_card(mask, bbox, img, corners)
+
+
+    def process_card(self, bbox, track_id, lookup, corners=None):
+        # Lookup failures are reported per card
+        if not lookup.ok:
+            print(f"Card {lookup.card_id} not found: {lookup.error}")
+            self.errors[track_id] = lookup.error
             return
+        card = lookup.card
 
         # Store the result
         self.results[track_id] = card
 
         # Draw bounding box and label on the original image
-        
-        label = f"ID: {track_id} - {card.name}"
-        if self.img.shape[1] > 1500:
-            cv2.putText(self.img, label, (x_min, int(bbox[1]) + 30),
+        self.draw_card(self.img, bbox, f"ID: {track_id} - {card.name}", corners)
+
+
+    def draw_card(self, img, bbox, label, corners=None):
+        x_min, y_min, x_max, y_max = corners or self.get_bbox_corner(bbox, img)
+        if img.shape[1] > 1500:
+            cv2.putText(img, label, (x_min, int(bbox[1]) + 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 2, (0, 0, 0), 10)
-            cv2.putText(self.img, label, (x_min, int(bbox[1]) + 30),
+            cv2.putText(img, label, (x_min, int(bbox[1]) + 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 2, (255, 0, 0), 5)
-            cv2.rectangle(self.img, (x_min, y_min), (x_max, y_max), (255, 0, 0), 8)
+            cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (255, 0, 0), 8)
         else:
-            cv2.rectangle(self.img, (x_min, y_min), (x_max, y_max), (255, 0, 0), 3)
-            cv2.putText(self.img, label, (x_min, int(bbox[1]) + 30),
+            cv2.rectangle(img, (x_min, y_min), (x_max, y_max), (255, 0, 0), 3)
+            cv2.putText(img, label, (x_min, int(bbox[1]) + 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0, 0, 0), 8)
-            cv2.putText(self.img, label, (x_min, int(bbox[1]) + 30),
+            cv2.putText(img, label, (x_min, int(bbox[1]) + 30),
                         cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 0, 0), 2)
 
 
+    def match_cards(self, img, masks, bboxs, filters=None, crops=None):
+        '''
+        Crops every detected card and identifies all of them in one batched pass.
+        Does not touch the scan state on self, so pipeline stages can call it
+        return corners, matches: bbox corners and top card ids of every card
+        '''
+        corners, matches = self.identify_cards(img, masks, bboxs, filters, crops)
+        return corners, [card_ids for card_ids, _ in matches]
+
+
+    def identify_cards(self, img, masks, bboxs, filters=None, crops=None, n=5):
+        '''
+        match_cards with the similarity scores, for callers reporting them
+        return corners, matches: bbox corners and (top n card ids, scores) of every card,
+            see Retriever.get_card_matches
+        '''
+        # bbox corners are computed once per card, for the crop and the drawing
+        corners = [self.get_bbox_corner(bbox, img) for bbox in bboxs]
+        if crops is None:
+            crops = [self.crop_card(masks[i], bboxs[i], img, corners[i]) for i in range(len(bboxs))]
+        return corners, self.ret.get_card_matches(crops, n, filters)
 
-    def process_all_cards(self):
+
+    def process_all_cards(self, crops=None):
         self.results = {}
+        self.errors = {}
+
+        corners, all_matches = self.match_cards(self.img, self.masks, self.bboxs, self.filters, crops)
+
+        # look every card up at once instead of one round trip after the other;
+        # cards without any match (filters that select no card) are not looked up
+        matched = [i for i, matches in enumerate(all_matches) if matches]
+        lookups = dict(zip(matched, self.lookup.find_all([all_matches[i][0] for i in matched])))
+
+        for i in range(len(self.bboxs)):
+            if i not in lookups:
+                print(f"Card {self.track_ids[i]} has no match for the filters {self.filters}")
+                self.errors[self.track_ids[i]] = LookupError("No card matches the filters")
+                continue
+            self.process_card(self.bboxs[i], self.track_ids[i], lookups[i], corners[i])
+
+
+    # Main function to run the model, detect and process the image
+    # filters (e.g. {"set_id": "base1", "supertype": "Pokémon"}) restrict the
+    # cards considered, see Retriever.filter_rows; tiled runs the detector on
+    # overlapping tiles, for high resolution binder pages and flat-lays
+    def process_image(self, file, filters=None, tiled=False):
+        if tiled:
+            detections = self.det.detect_tiled(file)
+        else:
+            detections = next(self.det.detect_batch([file]))
+        self.process_detections(detections, filters)
+
+
+    # Binder page fast path: slices the pockets of a 9 / 12 pocket page
+    # directly instead of segmenting it (see binder.py). Falls back to the
+    # detector when no pocket grid is found; returns whether the grid was used
+    def process_binder(self, file, filters=None, layouts=DEFAULT_LAYOUTS):
+        frame = cv2.imread(file) if isinstance(file, str) else file
+        if frame is None:
+            raise FileNotFoundError(f"Could not read image {file}")
+        img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        grid = detect_grid(img, layouts)
+        if grid is None:
+            self.process_detections(next(self.det.detect_batch([frame])), filters)
+            return False
+
+        bboxs, crops = slice_pockets(img, grid)
+        self.filters = filters
+        self.img = img
+        self.masks = None
+        self.bboxs = bboxs
+        self.track_ids = list(range(len(bboxs)))
+        if not crops:
+            print("No cards detected")
+            self.results = {}
+            self.errors = {}
+            return True
+
+        self.process_all_cards(crops)
+        return True
 
-        # Loop over masks and create asynchronous tasks for each card
-        for i in range(len(self.masks)):
-            self.process_card(self.masks[i], self.bboxs[i], self.track_ids[i])
-
-
-    # Main function to run the model, track and process the image
-    def process_image(self, file):
-        img = cv2.imread(file)
-        self.img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        results = self.det.model.track(file)
-        try:
-            result = results[0]
-            self.masks = (result.masks.data.numpy() * 255).astype("uint8")
-            self.bboxs = result.boxes.xywh.data.numpy()
-            self.track_ids = results[0].boxes.id.int().cpu().tolist()
-        except:
+
+    # Process many images, batch_size at a time through the detector;
+    # yields (detections, results, marked up img) per image
+    def process_images(self, files, filters=None, batch_size=8):
+        for detections in self.det.detect_batch(files, batch_size):
+            self.process_detections(detections, filters)
+            yield detections, self.results, self.img
+
+
+    def process_detections(self, detections, filters=None):
+        self.filters = filters
+        self.img = detections.image
+        self.masks = detections.masks
+        self.bboxs = detections.bboxs
+        self.track_ids = detections.ids
+        if len(detections) == 0:
             print("No cards detected")
             self.results = {}
+            self.errors = {}
             return
-        
+
         self.process_all_cards()
 
 # sample usage:
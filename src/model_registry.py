@@ -0,0 +1,106 @@
+# Process-wide registry of loaded models
+#
+# Loading the YOLO detector, the embedding model and the embedding index takes
+# seconds. Streamlit re-executes app.py on every interaction, but imported
+# modules stay in sys.modules, so resources registered here are loaded once
+# per server process and shared by every session and rerun. start_warmup()
+# loads and exercises the default Model on a background thread at server
+# start, so pages render while the weights are still loading.
+
+import logging
+import threading
+
+import numpy as np
+from PIL import Image
+
+_lock = threading.Lock()
+_resources = {}
+_resource_locks = {}
+_warmup_thread = None
+_warmed_up = threading.Event()
+_warmup_error = None
+
+# Model keeps the state of the current scan (img, results) on the instance,
+# so callers sharing it serialise their scans with this lock
+model_lock = threading.Lock()
+
+
+def get_resource(name, factory):
+    '''
+    Returns the shared instance registered under name, creating it with
+    factory() on first use. Concurrent first callers wait for one load.
+    @param name: Registry key
+    @param factory: Zero-argument callable building the resource
+    '''
+    resource = _resources.get(name)
+    if resource is not None:
+        return resource
+
+    with _lock:
+        resource_lock = _resource_locks.setdefault(name, threading.Lock())
+    with resource_lock:
+        if name not in _resources:
+            logging.info(f"Loading {name}")
+            _resources[name] = factory()
+        return _resources[name]
+
+
+def get_model(**kwargs):
+    '''
+    The shared default Model (detector + retriever + index)
+    @param kwargs: Model options, only used by the call that creates it
+    '''
+    # imported here so that importing the registry stays cheap
+    from model import Model
+    return get_resource("model", lambda: Model(**kwargs))
+
+
+def warm_up(model):
+    # one dummy inference through each stage, so the first real scan does not
+    # pay for lazy initialisation (kernel selection, allocator growth, ...)
+    blank = np.zeros((model.det.imgsz, model.det.imgsz, 3), dtype=np.uint8)
+    for _ in model.det.detect_batch([blank]):
+        pass
+    model.ret.embed_uncached([Image.new('RGB', (224, 224))])
+
+
+def _warmup(kwargs):
+    global _warmup_error
+    try:
+        warm_up(get_model(**kwargs))
+    except Exception as e:
+        _warmup_error = e
+        logging.error(f"Model warm-up failed: {e}")
+    finally:
+        _warmed_up.set()
+
+
+def start_warmup(**kwargs):
+    '''
+    Loads and warms up the shared Model on a background thread. Safe to call
+    on every Streamlit rerun, only the first call starts the thread.
+    '''
+    global _warmup_thread
+    with _lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=_warmup, args=(kwargs,),
+                                              name="model-warmup", daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def is_ready():
+    # True once the warm-up has finished successfully
+    return _warmed_up.is_set() and _warmup_error is None
+
+
+def wait_until_ready(timeout=None):
+    '''
+    Blocks until the warm-up finished
+    @param timeout: Seconds to wait, None waits forever
+    return ready: Whether the models are loaded and warmed up
+    '''
+    _warmed_up.wait(timeout)
+    if _warmup_error is not None:
+        raise _warmup_error
+    return is_ready()
@@ -0,0 +1,284 @@
+# Pipelined scanning of many photos
+#
+# Model.process_image runs decode -> detect -> crop/embed -> Card.find -> draw
+# strictly in sequence, so the CPU idles while the API answers and the
+# network idles while the models run. ScanPipeline runs each step as a stage
+# with its own worker threads, connected by bounded queues: decoding and the
+# metadata lookups (I/O bound) get several threads, detection and embedding
+# (tensor bound) one thread each with an explicit intra-op thread count. While
+# image N is being looked up, image N+1 is embedded and N+2 detected. The
+# bounded queues keep at most a few decoded images in memory at a time.
+#
+# usage:
+#   python src/pipeline.py res/photos --lookup-workers 8 --torch-threads 4 --compare
+
+import argparse
+import os
+import queue
+import threading
+import time
+
+import cv2
+import torch
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+_DONE = object()
+
+
+class StageError:
+    # an item whose processing failed, passed through the remaining stages untouched
+    def __init__(self, stage, error) -> None:
+        self.stage = stage
+        self.error = error
+
+    def __repr__(self):
+        return f"StageError({self.stage}: {self.error!r})"
+
+
+class Stage:
+    def __init__(self, name, fn, workers=1) -> None:
+        '''
+        @param name: Stage name, used in errors and timings
+        @param fn: Callable applied to every item coming from the previous stage
+        @param workers: Number of threads running fn; more than one only for
+            I/O bound or thread-safe stages
+        '''
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.busy = 0.0  # seconds spent in fn, summed over the workers
+        self.lock = threading.Lock()
+        self.running = 0
+
+
+class Pipeline:
+    def __init__(self, stages, queue_size=4) -> None:
+        '''
+        @param stages: Stages in order, the output of one is the input of the next
+        @param queue_size: Capacity of the queue in front of every stage
+        '''
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items):
+        '''
+        Pushes items through every stage
+        @param items: Iterable of inputs of the first stage
+        return outputs: Generator of the outputs of the last stage, in input order;
+            items that failed in a stage come out as StageError
+        '''
+        stop = threading.Event()
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+
+        def put(q, value):
+            # blocking put that gives up once the consumer went away
+            while not stop.is_set():
+                try:
+                    q.put(value, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def feed():
+            try:
+                for index, item in enumerate(items):
+                    if not put(queues[0], (index, item)):
+                        return
+            finally:
+                for _ in range(self.stages[0].workers):
+                    put(queues[0], _DONE)
+
+        def work(k, stage):
+            source, sink = queues[k], queues[k + 1]
+            while not stop.is_set():
+                try:
+                    entry = source.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                if entry is _DONE:
+                    break
+                index, item = entry
+                if not isinstance(item, StageError):
+                    start = time.perf_counter()
+                    try:
+                        item = stage.fn(item)
+                    except Exception as e:
+                        item = StageError(stage.name, e)
+                    with stage.lock:
+                        stage.busy += time.perf_counter() - start
+                if not put(sink, (index, item)):
+                    return
+            # the last worker of a stage to finish tells every worker of the next one
+            with stage.lock:
+                stage.running -= 1
+                last = stage.running == 0
+            if last:
+                downstream = self.stages[k + 1].workers if k + 1 < len(self.stages) else 1
+                for _ in range(downstream):
+                    put(sink, _DONE)
+
+        threads = [threading.Thread(target=feed, name="pipeline-feed", daemon=True)]
+        for k, stage in enumerate(self.stages):
+            stage.running = stage.workers
+            threads += [threading.Thread(target=work, args=(k, stage), name=f"pipeline-{stage.name}-{i}",
+                                         daemon=True) for i in range(stage.workers)]
+        for thread in threads:
+            thread.start()
+
+        # restore input order, later images can overtake earlier ones in multi-worker stages
+        pending, next_index = {}, 0
+        try:
+            while True:
+                entry = queues[-1].get()
+                if entry is _DONE:
+                    break
+                pending[entry[0]] = entry[1]
+                while next_index in pending:
+                    yield pending.pop(next_index)
+                    next_index += 1
+            for index in sorted(pending):
+                yield pending[index]
+        finally:
+            # stops the workers when the consumer breaks off early, each finishes its current item
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def timings(self):
+        # {stage name: busy seconds}
+        return {stage.name: stage.busy for stage in self.stages}
+
+
+class ScanResult:
+    def __init__(self, source, detections=None, results=None, image=None, error=None, errors=None) -> None:
+        self.source = source
+        self.detections = detections
+        self.results = results or {}  # track id -> Card
+        self.image = image            # marked up RGB image
+        self.error = error            # StageError when the image could not be scanned
+        self.errors = errors or {}    # track id -> lookup error of the cards that failed
+
+
+class ScanPipeline:
+    def __init__(self, model, decode_workers=2, lookup_workers=8, queue_size=4, torch_threads=None,
+                 filters=None) -> None:
+        '''
+        @param model: Model whose detector, retriever and lookups are used
+        @param decode_workers: Threads reading and decoding image files
+        @param lookup_workers: Threads fetching card metadata and drawing
+        @param queue_size: Images buffered between two stages
+        @param torch_threads: Intra-op threads of the tensor stages, None keeps the default
+        @param filters: Retriever filters, see Retriever.filter_rows
+        '''
+        self.model = model
+        self.filters = filters
+        if torch_threads:
+            torch.set_num_threads(torch_threads)
+        self.pipeline = Pipeline([
+            Stage("decode", self.decode, decode_workers),
+            Stage("detect", self.detect),
+            Stage("match", self.match),
+            Stage("lookup", self.lookup, lookup_workers),
+        ], queue_size)
+
+    def decode(self, path):
+        frame = cv2.imread(path)
+        if frame is None:
+            raise FileNotFoundError(f"Could not read image {path}")
+        return path, frame
+
+    def detect(self, item):
+        path, frame = item
+        detections = next(self.model.det.detect_batch([frame]))
+        detections.source = path
+        return detections
+
+    def match(self, detections):
+        corners, matches = self.model.match_cards(detections.image, detections.masks, detections.bboxs,
+                                                  self.filters)
+        return detections, corners, matches
+
+    def lookup(self, item):
+        detections, corners, matches = item
+        results, errors = {}, {}
+        matched = [i for i, card_ids in enumerate(matches) if card_ids]
+        lookups = dict(zip(matched, self.model.lookup.find_all([matches[i][0] for i in matched])))
+        for i, (bbox, track_id, corner) in enumerate(zip(detections.bboxs, detections.ids, corners)):
+            lookup = lookups.get(i)
+            if lookup is None:
+                # the filters select no card
+                errors[track_id] = LookupError("No card matches the filters")
+                continue
+            if not lookup.ok:
+                errors[track_id] = lookup.error
+                continue
+            results[track_id] = lookup.card
+            self.model.draw_card(detections.image, bbox, f"ID: {track_id} - {lookup.card.name}", corner)
+        return ScanResult(detections.source, detections, results, detections.image, errors=errors)
+
+    def run(self, paths):
+        '''
+        Scans image files
+        @param paths: Iterable of image file paths
+        return results: Generator of ScanResult, one per path, in order
+        '''
+        paths = list(paths)
+        for path, output in zip(paths, self.pipeline.run(paths)):
+            if isinstance(output, StageError):
+                yield ScanResult(path, error=output)
+            else:
+                yield output
+
+    def timings(self):
+        return self.pipeline.timings()
+
+
+def list_images(folder):
+    return [os.path.join(folder, name) for name in sorted(os.listdir(folder))
+            if name.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def main():
+    from model import Model
+
+    parser = argparse.ArgumentParser(description="Scan a folder of photos through the pipelined executor")
+    parser.add_argument("folder", help="folder of photos")
+    parser.add_argument("--decode-workers", type=int, default=2)
+    parser.add_argument("--lookup-workers", type=int, default=8)
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--torch-threads", type=int, default=None)
+    parser.add_argument("--compare", action="store_true",
+                        help="also time the sequential Model.process_image loop")
+    args = parser.parse_args()
+
+    paths = list_images(args.folder)
+    if not paths:
+        parser.error(f"no images in {args.folder}")
+    model = Model()
+    scanner = ScanPipeline(model, args.decode_workers, args.lookup_workers, args.queue_size, args.torch_threads)
+
+    start = time.perf_counter()
+    cards = failed = 0
+    for result in scanner.run(paths):
+        if result.error is not None:
+            failed += 1
+            print(f"{result.source}: {result.error}")
+        else:
+            cards += len(result.results)
+    elapsed = time.perf_counter() - start
+    print(f"pipelined:  {len(paths)} images, {cards} cards, {failed} failed in {elapsed:.1f}s "
+          f"({len(paths) / elapsed * 60:.1f} images/min)")
+    print("stage busy time: " + ", ".join(f"{name} {busy:.1f}s" for name, busy in scanner.timings().items()))
+
+    if args.compare:
+        start = time.perf_counter()
+        for path in paths:
+            model.process_image(path)
+        elapsed = time.perf_counter() - start
+        print(f"sequential: {len(paths)} images in {elapsed:.1f}s ({len(paths) / elapsed * 60:.1f} images/min)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# Perspective rectification of detected cards
+#
+# An axis-aligned bbox crop of a tilted card includes background, and the
+# square resize in the embedder's preprocessing distorts it further. Instead,
+# a quadrilateral is fitted to the card's segmentation mask and the card is
+# warped, in a single remap, straight to the embedder's square input - the
+# same upright, full-frame view the reference scans are embedded from.
+
+import cv2
+import numpy as np
+
+
+def order_corners(quad):
+    # clockwise order starting at the corner closest to the image's top-left,
+    # rotated so that the first edge is a short one (portrait card)
+    centre = quad.mean(axis=0)
+    angles = np.arctan2(quad[:, 1] - centre[1], quad[:, 0] - centre[0])
+    quad = quad[np.argsort(angles)]
+    quad = np.roll(quad, -int(np.argmin(quad.sum(axis=1))), axis=0)
+    top = np.linalg.norm(quad[1] - quad[0]) + np.linalg.norm(quad[2] - quad[3])
+    side = np.linalg.norm(quad[3] - quad[0]) + np.linalg.norm(quad[2] - quad[1])
+    if top > side:
+        # card lying on its side, start from the bottom-left corner instead
+        quad = np.roll(quad, 1, axis=0)
+    return quad.astype(np.float32)
+
+
+def fit_quad(mask, min_area=64):
+    '''
+    Fits a quadrilateral to the largest blob of a card mask
+    @param mask: uint8 mask (0 or 255)
+    @param min_area: Blobs smaller than this (in mask pixels) are ignored
+    return quad: (4, 2) float32 corners in mask coordinates, clockwise from the card's
+        top-left, or None when there is no usable blob
+    '''
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contours:
+        return None
+    contour = max(contours, key=cv2.contourArea)
+    if cv2.contourArea(contour) < min_area:
+        return None
+
+    # simplify the convex hull until 4 corners are left; rounded card corners
+    # and mask noise can need a coarser tolerance than a clean polygon
+    hull = cv2.convexHull(contour)
+    perimeter = cv2.arcLength(hull, True)
+    for tolerance in (0.02, 0.04, 0.06, 0.08, 0.1):
+        approx = cv2.approxPolyDP(hull, tolerance * perimeter, True)
+        if len(approx) == 4:
+            return order_corners(approx.reshape(4, 2).astype(np.float32))
+        if len(approx) < 4:
+            break
+    # fall back to the minimum-area rectangle
+    return order_corners(cv2.boxPoints(cv2.minAreaRect(contour)))
+
+
+def rectify_card(img, mask, size):
+    '''
+    Warps a detected card to an upright size x size embedder input
+    @param img: RGB numpy image
+    @param mask: uint8 mask of the card, mapping linearly onto img
+    @param size: Side of the embedder's (square) input
+    return card: (size, size, 3) uint8 array, or None when no quadrilateral fits
+    '''
+    quad = fit_quad(mask)
+    if quad is None:
+        return None
+    quad *= np.array([img.shape[1] / mask.shape[1], img.shape[0] / mask.shape[0]], dtype=np.float32)
+    target = np.array([[0, 0], [size, 0], [size, size], [0, size]], dtype=np.float32)
+    transform = cv2.getPerspectiveTransform(quad, target)
+    return cv2.warpPerspective(img, transform, (size, size), flags=cv2.INTER_LINEAR,
+                               borderMode=cv2.BORDER_REPLICATE)
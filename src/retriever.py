@@ -1,67 +1,280 @@
 # Setup
-import torch.nn as nn
+import cv2
+import numpy as np
 import torch
-import torchvision.models as models
+import torch.nn.functional as F
 import torchvision.transforms as transforms
-import re
+from PIL import Image
+from embedding_backends import INPUT_SIZE, load_backend
+from embedding_index import load_index
+from ann_index import IVFIndex
+from lru_cache import LRUCache
+
+
+def make_transform(size=INPUT_SIZE):
+    # define preprocessing transform
+    return transforms.Compose([
+        transforms.Resize((size, size)),
+        transforms.ToTensor(),
+        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+    ])
+
+
+class FilterError(ValueError):
+    # the filters cannot be applied to this index (see Retriever.filter_rows)
+    pass
 
 
 class Retriever:
-    def __init__(self, embeddings_path) -> None:
-        model = models.resnet18(pretrained=False)
-        model = torch.nn.Sequential(*list(model.children())[:-1])  # Remove the classification head
-        model.eval()
-        model.load_state_dict(torch.load("res/detection_weights/resnet18_embeddings.pth", map_location=torch.device('cpu')))
-        self.model = model
-
-        # define preprocessing transform
-        self.transform = transforms.Compose([
-            transforms.Resize((224, 224)),
-            transforms.ToTensor(),
-            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-        ])
-        self.dataset = torch.load(embeddings_path)
+    def __init__(self, embeddings_path, max_batch_size=16, ann_index_path=None, nprobe=None,
+                 rerank=32, prefilter=None, embedding_cache=None, backend=None) -> None:
+        # embedding backend (see embedding_backends.py), eager PyTorch by default
+        self.model = backend or load_backend("eager")
+        self.max_batch_size = max_batch_size
+
+        # reference embeddings as an (N, D) matrix with the card id of each row
+        # (a legacy .pt dict is still accepted, but is slow to load)
+        index = load_index(embeddings_path)
+
+        # crops are embedded at the resolution the index was built with
+        # (build_index.py --input-size, e.g. 160 for rectified crops)
+        self.input_size = index.input_size
+        self.transform = make_transform(self.input_size)
+        self.card_ids, self.embeddings = index.card_ids, index.embeddings
+        self.rows = {card_id: i for i, card_id in enumerate(self.card_ids)}
+
+        # indexes saved with --storage float16/int8 are scanned in compressed
+        # form, with the top `rerank` candidates re-scored in float32
+        self.quantized = index.quantized
+        self.rerank = rerank
+
+        # optional approximate (IVF) index built by ann_index.py, the exact
+        # scan stays available with get_batch_matches(..., exact=True)
+        self.ann = None
+        if ann_index_path is not None:
+            self.ann = IVFIndex.load(ann_index_path, self.embeddings)
+            if nprobe is not None:
+                self.ann.nprobe = nprobe
+
+        # optional HashPrefilter for the cascaded hash -> embedding mode
+        self.prefilter = prefilter
+
+        # optional EmbeddingCache, repeated crops skip the model
+        self.embedding_cache = embedding_cache
+
+        # card metadata columns and per-set row ranges, for filtered searches
+        self.metadata = None
+        if index.metadata is not None:
+            self.metadata = {field: np.array(values) for field, values in index.metadata.items()}
+        self.partitions = index.partitions or {}
+        # row sets of recently used filters, bounded by count and size
+        self.filter_cache = LRUCache(max_items=64, max_bytes=64 * 2 ** 20)
+
+
+    def embed(self, images):
+        if self.embedding_cache is None:
+            return self.embed_uncached(images)
+
+        # only crops that are not (near-)duplicates of a cached crop are embedded
+        keys = [self.embedding_cache.key(image) for image in images]
+        vectors = [self.embedding_cache.get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            computed = self.embed_uncached([images[i] for i in missing])
+            for i, vector in zip(missing, computed):
+                self.embedding_cache.put(keys[i], vector)
+                vectors[i] = vector
+        return torch.stack(vectors)
+
+
+    def embed_uncached(self, images):
+        # preprocess all crops together and run them through the model in
+        # chunks of at most max_batch_size
+        vectors = []
+        for start in range(0, len(images), self.max_batch_size):
+            chunk = images[start:start + self.max_batch_size]
+            input_tensor = torch.stack([self.transform(image) for image in chunk])
+            vectors.append(self.model(input_tensor))
+        return torch.cat(vectors)
 
 
     def get_card_id(self, image):
-        # TODO if opencv2 image, convert to PIL
-        input_tensor = self.transform(image).unsqueeze(0)
-        with torch.no_grad():
-            target_vector = self.model(input_tensor).flatten().unsqueeze(0)
+        # an OpenCV image (BGR numpy array) is converted to an RGB PIL image
+        if isinstance(image, np.ndarray):
+            image = Image.fromarray(cv2.cvtColor(image, cv2.COLOR_BGR2RGB))
+        return self.get_card_ids([image])[0]
 
-        sim_dict = self.get_matches(target_vector, 5)
-        return sim_dict
+
+    def get_card_ids(self, images, n=5, filters=None):
+        # top n card ids for each crop, using one batched forward pass
+        # (filters: see filter_rows)
+        return [card_ids for card_ids, _ in self.get_card_matches(images, n, filters)]
+
+
+    def get_card_matches(self, images, n=5, filters=None):
+        '''
+        Identifies a batch of crops: one forward pass for the crops that need the
+        model, going through the hash prefilter cascade when one is set
+        @param filters: See filter_rows
+        return matches: (top n card ids, their cosine similarities) per crop; crops the
+            hash prefilter answers skip the model and have None scores
+        '''
+        if len(images) == 0:
+            return []
+        if self.prefilter is None:
+            vectors = self.embed(images)
+            matches = self.get_batch_matches(vectors, n, filters=filters)
+            return list(zip(matches, self.get_batch_scores(vectors, matches)))
+
+        # cascade: confident hash matches skip the model entirely, the other
+        # crops are re-ranked by embedding within their hash shortlist
+        results = [None] * len(images)
+        pending, shortlists = [], []
+        allowed = self.filter_rows(filters)
+        allowed = set(allowed.tolist()) if allowed is not None else None
+        for i, image in enumerate(images):
+            accepted, card_ids = self.prefilter.check(image, n)
+            if accepted and allowed is not None:
+                # a confident hash match outside the filters (e.g. a reprint from
+                # another set) does not count: the crop is embedded and searched
+                # among the filtered cards only
+                kept = [card_id for card_id in card_ids if self.rows.get(card_id) in allowed]
+                if not kept or kept[0] != card_ids[0]:
+                    accepted, card_ids = False, []
+                    self.prefilter.stats["accepted"] -= 1
+                    self.prefilter.stats["shortlisted"] += 1
+                else:
+                    card_ids = kept
+            if accepted:
+                results[i] = (card_ids, [None] * len(card_ids))
+            else:
+                pending.append(i)
+                shortlists.append(card_ids)
+
+        if pending:
+            vectors = self.embed([images[i] for i in pending])
+            matches = [self.get_shortlist_matches(vector, shortlist, n, filters)
+                       for vector, shortlist in zip(vectors, shortlists)]
+            for i, card_ids, scores in zip(pending, matches, self.get_batch_scores(vectors, matches)):
+                results[i] = (card_ids, scores)
+        return results
+
+
+    def get_shortlist_matches(self, target_vector, shortlist, n=5, filters=None):
+        # top n card ids among the shortlisted cards only
+        rows = [self.rows[card_id] for card_id in shortlist if card_id in self.rows]
+        allowed = self.filter_rows(filters)
+        if allowed is not None:
+            allowed = set(allowed.tolist())
+            rows = [row for row in rows if row in allowed]
+        if not rows:
+            return self.get_batch_matches(target_vector.reshape(1, -1), n, filters=filters)[0]
+
+        queries = F.normalize(target_vector.reshape(1, -1).float(), dim=1)
+        return self.search_rows(queries, torch.tensor(rows), n)[0]
+
+
+    def get_batch_scores(self, target_vectors, matches):
+        # cosine similarity of each query to each of its matched card ids
+        queries = F.normalize(target_vectors.float(), dim=1)
+        scores = []
+        for query, card_ids in zip(queries, matches):
+            rows = [self.rows[card_id] for card_id in card_ids]
+            scores.append((self.embeddings[rows].float() @ query).tolist() if rows else [])
+        return scores
+
+
+    def filter_rows(self, filters):
+        '''
+        Rows of the index that pass the filters, whole set partitions are
+        selected first and only their rows are checked against the rest
+        @param filters: None, or a dict with any of
+            "set_id": set id or list of set ids,
+            "supertype": supertype or list of supertypes ("Pokémon", "Trainer", "Energy"),
+            "released_after" / "released_before": inclusive "YYYY/MM/DD" bounds
+        return rows: LongTensor of row ids, or None when nothing is filtered
+        '''
+        if not filters:
+            return None
+        if self.metadata is None:
+            raise FilterError("This embedding index has no card metadata, rebuild it with --cards")
+
+        key = tuple(sorted((k, tuple(v) if isinstance(v, (list, tuple, set)) else v)
+                           for k, v in filters.items()))
+        rows = self.filter_cache.get(key)
+        if rows is not None:
+            return rows
+
+        set_ids = filters.get("set_id")
+        if set_ids is not None:
+            set_ids = [set_ids] if isinstance(set_ids, str) else set_ids
+            ranges = [self.partitions[s] for s in set_ids if s in self.partitions]
+            rows = np.concatenate([np.arange(start, end) for start, end in ranges]) \
+                if ranges else np.zeros(0, dtype=np.int64)
+        else:
+            rows = np.arange(len(self.card_ids))
+
+        mask = np.ones(len(rows), dtype=bool)
+        supertypes = filters.get("supertype")
+        if supertypes is not None:
+            supertypes = [supertypes] if isinstance(supertypes, str) else list(supertypes)
+            mask &= np.isin(self.metadata["supertype"][rows], supertypes)
+        # cards with an unknown release date never pass a date filter
+        dates = self.metadata["release_date"][rows]
+        if (filters.get("released_after") or filters.get("released_before")) \
+                and not (self.metadata["release_date"] != "").any():
+            raise FilterError("This embedding index has no release dates, rebuild it with --sets")
+        if filters.get("released_after"):
+            mask &= (dates != "") & (dates >= filters["released_after"])
+        if filters.get("released_before"):
+            mask &= (dates != "") & (dates <= filters["released_before"])
+
+        rows = torch.from_numpy(rows[mask].astype(np.int64))
+        self.filter_cache.put(key, rows)
+        return rows
+
+
+    def search_rows(self, queries, rows, n=5):
+        # exact top n card ids for each (normalised) query among the given rows only
+        if len(rows) == 0:
+            return [[] for _ in range(queries.shape[0])]
+        sims = queries @ self.embeddings[rows].float().T
+        top_n = torch.topk(sims, min(int(n), len(rows)), dim=1).indices
+        return [[self.card_ids[i] for i in row] for row in rows[top_n].tolist()]
   
 
     def get_matches(self, target_vector, n=5):
-        # initiate computation of cosine similarity
-        cosine = nn.CosineSimilarity(dim=1)
-
-        # iteratively store similarity of stored images to target image
-        sim_dict = {}
-        for k, v in self.dataset.items():
-            sim = cosine(v.unsqueeze(0), target_vector)[0].item()
-            sim_dict[k] = sim
-
-        # sort based on decreasing similarity
-        items = sim_dict.items()
-        sim_dict = {k: v for k, v in sorted(items, key=lambda i: i[1], reverse=True)}
-
-        # cut to defined top n similar images
-        if n is not None:
-            top_n_keys = [k for k, v in list(sim_dict.items())[:int(n)]]
-
-            # Apply transformation (regular expression) to each key in the list
-            transformed_keys = []
-            for key in top_n_keys:
-                match = re.search(r'\\([^\\]+)\.png', key)
-                if match:
-                    transformed_keys.append(match.group(1))  # Extracted part of the key
-                else:
-                    transformed_keys.append(key)  # If no match, keep the original key
+        if n is None:
+            return []  # If no matches found or `n` is None
+        return self.get_batch_matches(target_vector.reshape(1, -1), n)[0]
+
+
+    def get_batch_matches(self, target_vectors, n=5, exact=False, filters=None):
+        # top n card ids for each row of a (B, D) batch of query vectors
+        if n is None or len(self.card_ids) == 0:
+            return [[] for _ in range(target_vectors.shape[0])]
+
+        queries = F.normalize(target_vectors.float(), dim=1)
+
+        # filtered searches only score the selected partitions
+        rows = self.filter_rows(filters)
+        if rows is not None:
+            return self.search_rows(queries, rows, n)
+
+        if self.ann is not None and not exact:
+            rows = self.ann.search(queries, int(n))
+            return [[self.card_ids[i] for i in row] for row in rows]
 
-            return transformed_keys
+        if self.quantized is not None and not exact:
+            rows = self.quantized.search(queries, self.embeddings, int(n), self.rerank)
+            return [[self.card_ids[i] for i in row] for row in rows]
 
-        return []  # If no matches found or `n` is None
+        # cosine similarity against every reference card is a single
+        # matrix product, since both sides are unit length
+        sims = queries @ self.embeddings.T
 
+        # partial selection of the top n similar images (sorted by decreasing similarity)
+        k = min(int(n), sims.shape[1])
+        top_n = torch.topk(sims, k, dim=1).indices.tolist()
 
+        return [[self.card_ids[i] for i in row] for row in top_n]
@@ -0,0 +1,340 @@
+# Local HTTP scan service
+#
+# Lets other tools identify cards without Streamlit: POST the bytes of a photo
+# to /scan and get the detected cards back as JSON. Requests are handled on
+# their own threads, but the models run on one batcher thread: it takes the
+# first queued photo, holds it for up to max_wait seconds while more arrive,
+# and runs them all through the Detector and the Retriever as one batch (one
+# YOLO forward pass, one batched identification of every card of every photo,
+# through the hash prefilter when the Model has one). The
+# card lookups then run back on the request threads, concurrently and
+# coalesced (see card_lookup.py), while the next batch is on the models.
+#
+# Backpressure: at most max_queue photos wait for the batcher, further ones
+# are refused right away with 503 and a Retry-After header instead of piling
+# up, and request bodies are capped at max_body bytes.
+#
+#   POST /scan[?top_k=5&lookup=0&set_id=sv2]   image bytes -> {"cards": [...], "timing": {...}}
+#   GET  /healthz   the process is up
+#   GET  /readyz    200 once the models are loaded and warmed up (see model_registry.py), 503 before
+#   GET  /stats     batching and backpressure counters
+#
+# usage:
+#   python src/scan_server.py --port 8765 --max-batch 8 --max-wait-ms 10
+#   curl --data-binary @res/test.jpg http://127.0.0.1:8765/scan
+#   python tools/scan_load.py res/photos --url http://127.0.0.1:8765 --concurrency 16
+
+import argparse
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+import model_registry
+from retriever import FilterError
+
+MAX_BODY = 20 * 2 ** 20
+
+
+class Overloaded(Exception):
+    # the batcher queue is full, the client should retry later
+    pass
+
+
+class NotReady(Exception):
+    # the models are still loading
+    pass
+
+
+class ScanRequest:
+    def __init__(self, frame, top_k, filters) -> None:
+        self.frame = frame        # BGR numpy image
+        self.top_k = top_k
+        self.filters = filters
+        self.future = Future()
+        self.queued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    def __init__(self, max_batch=8, max_wait=0.01, max_queue=32, get_model=model_registry.get_model) -> None:
+        '''
+        Runs the photos of concurrent requests through the models together
+        @param max_batch: Photos per batch
+        @param max_wait: Seconds the first photo of a batch waits for more to arrive
+        @param max_queue: Photos waiting for the batcher before requests are refused
+        @param get_model: Returns the (warmed up) Model, called once the registry is ready
+        '''
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue(max_queue)
+        self.get_model = get_model
+        self.model = None
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "rejected": 0, "batches": 0, "images": 0, "cards": 0,
+                      "max_batch_seen": 0}
+        self.thread = threading.Thread(target=self.work, name="scan-batcher", daemon=True)
+        self.thread.start()
+
+    def count(self, stat, n=1):
+        with self.lock:
+            self.stats[stat] += n
+
+    def submit(self, frame, top_k=5, filters=None):
+        '''
+        Queues one photo
+        return future: concurrent.futures.Future of the photo's
+            (cards, batch size, seconds queued), see run_batch
+        '''
+        if self.model is None:
+            raise NotReady("The models are still loading")
+        request = ScanRequest(frame, top_k, filters)
+        try:
+            self.queue.put_nowait(request)
+        except queue.Full:
+            self.count("rejected")
+            raise Overloaded(f"{self.queue.maxsize} photos are already waiting")
+        self.count("requests")
+        return request.future
+
+    def work(self):
+        try:
+            model_registry.wait_until_ready()
+        except Exception as e:
+            logging.error(f"Scan batcher not started, the models failed to load: {e}")
+            return
+        self.model = self.get_model()
+
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            batch = [request for request in batch if request.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                # the Model may be shared with other callers in this process
+                with model_registry.model_lock:
+                    outputs = self.run_batch(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            for request, cards in zip(batch, outputs):
+                if isinstance(cards, Exception):
+                    request.future.set_exception(cards)
+                else:
+                    request.future.set_result((cards, len(batch), time.perf_counter() - request.queued_at))
+
+    def run_batch(self, batch):
+        '''
+        Detects and identifies the cards of every photo of a batch
+        return cards: Per photo, a list of {"bbox", "card_ids", "scores"} per card, or
+            the exception that failed the search of its (top_k, filters) group
+        '''
+        model = self.model
+        detections = list(model.det.detect_batch([request.frame for request in batch], len(batch)))
+
+        crops, owners = [], []
+        for k, found in enumerate(detections):
+            for i in range(len(found)):
+                corner = model.get_bbox_corner(found.bboxs[i], found.image)
+                crops.append(model.crop_card(found.masks[i], found.bboxs[i], found.image, corner))
+                owners.append((k, corner))
+
+        # one batched identification per distinct (top_k, filters) among the batch's
+        # requests, usually a single one; a search that fails (e.g. filters the index
+        # cannot apply) only fails the requests of its group
+        groups = {}
+        for j, (k, _) in enumerate(owners):
+            request = batch[k]
+            groups.setdefault((request.top_k, json.dumps(request.filters, sort_keys=True)), []).append(j)
+        matches = [None] * len(crops)
+        cards = [[] for _ in batch]
+        for rows in groups.values():
+            request = batch[owners[rows[0]][0]]
+            try:
+                found = model.ret.get_card_matches([crops[j] for j in rows], request.top_k, request.filters)
+            except Exception as e:
+                for j in rows:
+                    cards[owners[j][0]] = e
+                continue
+            for j, match in zip(rows, found):
+                matches[j] = match
+        for (k, corner), match in zip(owners, matches):
+            if match is None:
+                continue
+            card_ids, scores = match
+            cards[k].append({"bbox": [int(v) for v in corner], "card_ids": card_ids,
+                             "scores": [None if score is None else round(float(score), 4) for score in scores]})
+
+        with self.lock:
+            self.stats["batches"] += 1
+            self.stats["images"] += len(batch)
+            self.stats["cards"] += len(crops)
+            self.stats["max_batch_seen"] = max(self.stats["max_batch_seen"], len(batch))
+        return cards
+
+    def snapshot(self):
+        with self.lock:
+            stats = dict(self.stats)
+        stats["queued"] = self.queue.qsize()
+        stats["mean_batch"] = round(stats["images"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+
+def make_handler(batcher, max_body=MAX_BODY):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == "/healthz":
+                self.send_json(200, {"status": "ok"})
+            elif path == "/readyz":
+                try:
+                    ready = model_registry.wait_until_ready(timeout=0)
+                except Exception as e:
+                    self.send_json(503, {"ready": False, "error": str(e)})
+                    return
+                ready = ready and batcher.model is not None
+                self.send_json(200 if ready else 503, {"ready": ready})
+            elif path == "/stats":
+                self.send_json(200, batcher.snapshot())
+            else:
+                self.send_json(404, {"error": f"Unknown path {path}"})
+
+        def do_POST(self):
+            start = time.perf_counter()
+            url = urlparse(self.path)
+            if url.path != "/scan":
+                self.send_json(404, {"error": f"Unknown path {url.path}"})
+                return
+            length = int(self.headers.get("Content-Length") or 0)
+            if length <= 0:
+                self.send_json(411, {"error": "POST the image bytes with a Content-Length"})
+                return
+            if length > max_body:
+                self.send_json(413, {"error": f"Images are limited to {max_body} bytes"})
+                self.close_connection = True
+                return
+            data = self.rfile.read(length)
+
+            params = parse_qs(url.query)
+            try:
+                top_k = int(params.get("top_k", ["5"])[0])
+            except ValueError:
+                top_k = 0
+            if top_k < 1:
+                self.send_json(400, {"error": "top_k must be a positive integer"})
+                return
+            lookup = params.get("lookup", ["1"])[0] not in ("0", "false")
+            filters = {"set_id": params["set_id"]} if "set_id" in params else None
+
+            frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                self.send_json(400, {"error": "The body is not a readable image"})
+                return
+
+            try:
+                cards, batch_size, queued = batcher.submit(frame, top_k, filters).result()
+            except (NotReady, Overloaded) as e:
+                self.send_json(503, {"error": str(e)}, {"Retry-After": "1"})
+                return
+            except FilterError as e:
+                # filters the index cannot apply, any other error is the server's
+                self.send_json(400, {"error": str(e)})
+                return
+            except Exception as e:
+                logging.exception("Scan failed")
+                self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+                return
+
+            if lookup and cards:
+                # outside the batcher, so the next batch runs while these wait on the API
+                lookups = batcher.model.lookup.find_all([card["card_ids"][0] for card in cards if card["card_ids"]])
+                names = {result.card_id: result.card.name for result in lookups if result.ok}
+                for card in cards:
+                    card["name"] = names.get(card["card_ids"][0]) if card["card_ids"] else None
+
+            self.send_json(200, {"cards": cards, "timing": {
+                "batch_size": batch_size,
+                "queued_ms": round(queued * 1000, 1),
+                "total_ms": round((time.perf_counter() - start) * 1000, 1)}})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+
+    return Handler
+
+
+def serve(host="127.0.0.1", port=8765, max_batch=8, max_wait=0.01, max_queue=32, max_body=MAX_BODY,
+          **model_kwargs):
+    '''
+    Starts loading the models and returns the server, call serve_forever() on it
+    @param model_kwargs: Model options, see model_registry.get_model
+    '''
+    model_registry.start_warmup(**model_kwargs)
+    batcher = MicroBatcher(max_batch, max_wait, max_queue)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher, max_body))
+    server.daemon_threads = True
+    server.batcher = batcher
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local HTTP service identifying the cards of POSTed photos")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max-batch", type=int, default=8, help="photos run through the models together")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0,
+                        help="how long the first photo of a batch waits for others")
+    parser.add_argument("--max-queue", type=int, default=32, help="waiting photos before requests get 503")
+    parser.add_argument("--max-body-mb", type=float, default=MAX_BODY / 2 ** 20)
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads of the embedding backend")
+    parser.add_argument("--rectify", action="store_true", help="warp cards upright before embedding")
+    parser.add_argument("--detector", default=None, help="detector weights, default the Model's")
+    parser.add_argument("--index", default=None, help="embedding index, default the Model's")
+    parser.add_argument("--backend", default="eager", help="embedding backend, see embedding_backends.py")
+    parser.add_argument("--embedding-model", default=None, help="embedding model file of the backend")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    server = serve(args.host, args.port, args.max_batch, args.max_wait_ms / 1000, args.max_queue,
+                   int(args.max_body_mb * 2 ** 20), detector_path=args.detector, index_path=args.index,
+                   rectify=args.rectify, embedding_backend=args.backend,
+                   embedding_model_path=args.embedding_model, threads=args.threads)
+    logging.info(f"Serving on http://{args.host}:{server.server_address[1]} (models loading, see /readyz)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
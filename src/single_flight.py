@@ -0,0 +1,84 @@
+# Request coalescing ("single flight")
+#
+# Bulk lots are full of duplicate commons, and several users can scan the
+# same card at once, so identical card fetches often overlap. SingleFlight
+# lets the first caller for a key start the fetch while every concurrent
+# caller for the same key shares its future, and so its result or exception.
+# Nothing is cached: once the flight lands the next call fetches again.
+# A flight is registered when it is submitted, not when a worker picks it up,
+# so duplicates queued behind a bounded pool coalesce too. Threads use do()
+# or submit(); asyncio code awaits do_async() on the event loop. All of them
+# join the same flights, so threaded and asyncio callers coalesce together.
+#
+# usage:
+#   flights = SingleFlight()
+#   card = flights.do(card_id, lambda: fetch(card_id))
+#   future = flights.submit(card_id, executor, lambda: fetch(card_id))
+#   card = await flights.do_async(card_id, lambda: fetch(card_id), executor)
+#   flights.stats["coalesced"]
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    def __init__(self) -> None:
+        # reentrant: a done callback may run right away, inside submit's lock
+        self.lock = threading.RLock()
+        self.flights = {}  # key -> concurrent.futures.Future of the fetch in flight
+        self.stats = {"calls": 0, "coalesced": 0}
+
+    def join(self, key, start):
+        # future of the flight for key, start(key) begins a new one when none is in flight
+        with self.lock:
+            self.stats["calls"] += 1
+            future = self.flights.get(key)
+            if future is not None:
+                self.stats["coalesced"] += 1
+                return future, False
+            future = self.flights[key] = start()
+            future.add_done_callback(lambda done: self.land(key, done))
+            return future, True
+
+    def land(self, key, future):
+        with self.lock:
+            if self.flights.get(key) is future:
+                del self.flights[key]
+
+    def submit(self, key, executor, fn):
+        '''
+        Submits fn to executor unless a call for the same key is already in flight
+        @param key: Hashable identity of the request, e.g. the card id
+        @param executor: concurrent.futures executor running the fetch
+        @param fn: Zero-argument callable doing the request
+        return future: concurrent.futures.Future shared by every caller of the flight
+        '''
+        return self.join(key, lambda: executor.submit(fn))[0]
+
+    def do(self, key, fn):
+        '''
+        Runs fn() in the calling thread unless a call for the same key is already
+        in flight, in which case its result is waited for and shared
+        return value: fn's result; fn's exception is raised in every waiting caller
+        '''
+        future, leader = self.join(key, Future)
+        if leader and future.set_running_or_notify_cancel():
+            try:
+                future.set_result(fn())
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    async def do_async(self, key, fn, executor):
+        '''
+        submit() for asyncio callers, waiting on the event loop rather than in a thread
+        return value: fn's result; fn's exception is raised in every waiting caller
+        '''
+        return await asyncio.wrap_future(self.submit(key, executor, fn))
+
+    @property
+    def in_flight(self):
+        with self.lock:
+            return len(self.flights)
+
@@ -0,0 +1,162 @@
+# Streaming video / camera mode
+#
+# Frames go through the YOLO tracker with persistent state, so a card keeps
+# its track id while it stays in view. The embedding retrieval only runs for
+# tracks that have no identity yet, or whose identity confidence has decayed
+# below a threshold; every other frame reuses the cached card identity.
+#
+# usage:
+#   python src/stream.py sweep.mp4
+#   python src/stream.py 0 --show        (camera 0)
+
+import argparse
+import time
+
+import cv2
+
+
+class TrackIdentity:
+    def __init__(self, card_ids, score, frame) -> None:
+        self.card_ids = card_ids      # top-k card ids, best first
+        self.score = score            # cosine similarity of the best match when identified
+        self.confidence = score       # decays every frame the card is not re-identified
+        self.identified_at = frame
+        self.last_seen = frame
+
+    @property
+    def card_id(self):
+        return self.card_ids[0] if self.card_ids else None
+
+
+class CardStream:
+    def __init__(self, model, min_confidence=0.6, decay=0.98, max_age=90, forget_after=30,
+                 n=5, filters=None) -> None:
+        '''
+        @param model: Model whose detector and retriever are used
+        @param min_confidence: Re-identify a track once its confidence falls below this
+        @param decay: Per-frame multiplier applied to a track's confidence
+        @param max_age: Re-identify a track at least every max_age frames (0 = never)
+        @param forget_after: Drop a track's identity after this many frames out of view
+        @param filters: Retriever filters, see Retriever.filter_rows
+        '''
+        self.model = model
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.max_age = max_age
+        self.forget_after = forget_after
+        self.n = n
+        self.filters = filters
+        self.identities = {}  # track id -> TrackIdentity
+        self.frame_index = 0
+        self.stats = {"frames": 0, "track_frames": 0, "identified": 0}
+
+    def needs_identification(self, track_id):
+        identity = self.identities.get(track_id)
+        if identity is None:
+            return True
+        if identity.confidence < self.min_confidence:
+            return True
+        return bool(self.max_age) and self.frame_index - identity.identified_at >= self.max_age
+
+    def process_frame(self, frame):
+        '''
+        Tracks the cards in one BGR frame and identifies the ones that need it
+        @param frame: BGR numpy image
+        return detections, identities: The frame's Detections and {track id: TrackIdentity}
+            for every card visible in it
+        '''
+        detections = self.model.det.track(frame)
+        ret = self.model.ret
+
+        for identity in self.identities.values():
+            identity.confidence *= self.decay
+
+        pending = [i for i, track_id in enumerate(detections.ids) if self.needs_identification(track_id)]
+        if pending:
+            crops = [self.model.crop_card(detections.masks[i], detections.bboxs[i], detections.image)
+                     for i in pending]
+            for i, (card_ids, scores) in zip(pending, ret.get_card_matches(crops, self.n, self.filters)):
+                # a confident hash prefilter match has no cosine score, it counts as certain
+                best = (1.0 if scores[0] is None else scores[0]) if scores else 0.0
+                self.identities[detections.ids[i]] = TrackIdentity(card_ids, best, self.frame_index)
+            self.stats["identified"] += len(pending)
+
+        visible = {}
+        for track_id in detections.ids:
+            identity = self.identities[track_id]
+            identity.last_seen = self.frame_index
+            visible[track_id] = identity
+
+        # forget tracks that left the view
+        for track_id in [t for t, identity in self.identities.items()
+                         if self.frame_index - identity.last_seen > self.forget_after]:
+            del self.identities[track_id]
+
+        self.stats["frames"] += 1
+        self.stats["track_frames"] += len(detections)
+        self.frame_index += 1
+        return detections, visible
+
+    def annotate(self, detections, visible):
+        # draws the cached identity of every visible card on the (RGB) frame
+        img = detections.image
+        for bbox, track_id in zip(detections.bboxs, detections.ids):
+            identity = visible[track_id]
+            self.model.draw_card(img, bbox, f"ID: {track_id} - {identity.card_id} ({identity.confidence:.2f})")
+        return img
+
+    def run(self, source):
+        '''
+        Consumes a video file or camera
+        @param source: Video path, or camera index
+        return: Generator of (detections, identities) per frame
+        '''
+        capture = cv2.VideoCapture(source)
+        if not capture.isOpened():
+            raise IOError(f"Could not open video source {source}")
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    return
+                yield self.process_frame(frame)
+        finally:
+            capture.release()
+
+
+def main():
+    from model import Model
+
+    parser = argparse.ArgumentParser(description="Identify cards in a video file or camera stream")
+    parser.add_argument("source", help="video file, or camera index")
+    parser.add_argument("--min-confidence", type=float, default=0.6)
+    parser.add_argument("--decay", type=float, default=0.98)
+    parser.add_argument("--max-age", type=int, default=90)
+    parser.add_argument("--show", action="store_true", help="display the annotated frames")
+    args = parser.parse_args()
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    stream = CardStream(Model(), args.min_confidence, args.decay, args.max_age)
+
+    start = time.perf_counter()
+    known = {}
+    for detections, visible in stream.run(source):
+        for track_id, identity in visible.items():
+            if known.get(track_id) != identity.card_id:
+                known[track_id] = identity.card_id
+                print(f"frame {stream.frame_index - 1}: track {track_id} -> {identity.card_id} "
+                      f"({identity.score:.3f})")
+        if args.show:
+            img = stream.annotate(detections, visible)
+            cv2.imshow("cards", cv2.cvtColor(img, cv2.COLOR_RGB2BGR))
+            if cv2.waitKey(1) & 0xFF == ord('q'):
+                break
+
+    elapsed = time.perf_counter() - start
+    stats = stream.stats
+    print(f"{stats['frames']} frames in {elapsed:.1f}s ({stats['frames'] / max(elapsed, 1e-9):.1f} fps), "
+          f"{stats['identified']} identifications for {stats['track_frames']} card detections")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,6 @@
 from detector import Detector
 from retriever import Retriever
-from fifocache import FIFOCache
+from lru_cache import LRUCache
 import re
 import matplotlib.pyplot as plt
 from PIL import Image
@@ -90,7 +90,7 @@ def main():
     
     det = Detector("res\\detection_weights\\yolo11n_seg_best_10epochs.onnx")
     ret = Retriever("res\\classfication_embeddings\\ResNet18_embeddings.pt")
-    cards_cache = FIFOCache(30)
+    cards_cache = LRUCache(30)
 
     img = cv2.imread("res\\test.jpg")
     img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
@@ -0,0 +1,115 @@
+# Helpers for tiled detection on high-resolution photos
+#
+# A 12 MP binder page shrunk to the detector's 640 px input leaves small
+# cards only a few dozen pixels wide. Tiled mode runs the detector on
+# overlapping tiles at (close to) native resolution instead, then merges the
+# per-tile detections: boxes of the same card seen by two tiles, or pieces of
+# a card cut by a tile seam (boxes ending on facing internal tile edges), are
+# joined into one box and their masks are OR-ed together on a shared,
+# downscaled mask canvas.
+
+import cv2
+import numpy as np
+
+
+def tile_starts(length, tile_size, overlap):
+    # start offsets along one axis, the last tile is aligned to the far edge
+    if length <= tile_size:
+        return [0]
+    stride = max(1, int(tile_size * (1 - overlap)))
+    starts = list(range(0, length - tile_size, stride))
+    starts.append(length - tile_size)
+    return starts
+
+
+def make_tiles(height, width, tile_size, overlap):
+    '''
+    Overlapping tiles covering an image
+    @param tile_size: Side of a (square) tile in image pixels
+    @param overlap: Fraction of a tile shared with its neighbour, e.g. 0.2
+    return tiles: List of (x0, y0, x1, y1) rectangles
+    '''
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in tile_starts(height, tile_size, overlap)
+            for x in tile_starts(width, tile_size, overlap)]
+
+
+def _overlaps(a, b, iou_threshold, containment):
+    # same card if the boxes overlap a lot, or one is mostly inside the other
+    # (a card cut by a tile seam is detected as a partial box)
+    ix = max(0.0, min(a[2], b[2]) - max(a[0], b[0]))
+    iy = max(0.0, min(a[3], b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    if inter == 0:
+        return False
+    area_a = (a[2] - a[0]) * (a[3] - a[1])
+    area_b = (b[2] - b[0]) * (b[3] - b[1])
+    iou = inter / (area_a + area_b - inter)
+    return iou >= iou_threshold or inter / min(area_a, area_b) >= containment
+
+
+def cut_sides(box, tile, width, height, margin=2.0):
+    '''
+    Sides of a tile-level box that lie on an internal tile edge, i.e. where the
+    card may continue into the neighbouring tile
+    return sides: (left, top, right, bottom) booleans
+    '''
+    x0, y0, x1, y1 = tile
+    return (x0 > 0 and box[0] - x0 <= margin,
+            y0 > 0 and box[1] - y0 <= margin,
+            x1 < width and x1 - box[2] <= margin,
+            y1 < height and y1 - box[3] <= margin)
+
+
+def _span_overlap(lo_a, hi_a, lo_b, hi_b):
+    # 1-D overlap of two intervals, relative to the shorter one
+    inter = min(hi_a, hi_b) - max(lo_a, lo_b)
+    return inter / max(1e-6, min(hi_a - lo_a, hi_b - lo_b)) if inter > 0 else 0.0
+
+
+def _seam_joined(a, cuts_a, b, cuts_b, containment):
+    # pieces of one card cut by a seam: cut on facing sides, overlapping across
+    # the seam and lined up along it (a card wider than the tile overlap never
+    # fits whole in a tile, and its pieces overlap too little for _overlaps)
+    if _span_overlap(a[0], a[2], b[0], b[2]) == 0 or _span_overlap(a[1], a[3], b[1], b[3]) == 0:
+        return False
+    left, top, right, bottom = 0, 1, 2, 3
+    if (cuts_a[right] and cuts_b[left] and a[0] < b[0]) or (cuts_b[right] and cuts_a[left] and b[0] < a[0]):
+        return _span_overlap(a[1], a[3], b[1], b[3]) >= containment
+    if (cuts_a[bottom] and cuts_b[top] and a[1] < b[1]) or (cuts_b[bottom] and cuts_a[top] and b[1] < a[1]):
+        return _span_overlap(a[0], a[2], b[0], b[2]) >= containment
+    return False
+
+
+def merge_detections(boxes, scores, iou_threshold=0.5, containment=0.7, cuts=None):
+    '''
+    Greedily clusters boxes from different tiles that belong to the same card
+    @param boxes: (N, 4) xyxy boxes in image coordinates
+    @param scores: (N,) confidences, higher scores seed clusters first
+    @param cuts: Optional cut_sides of every box; pieces cut by the same seam are
+        joined even when their overlap is too small for the IoU / containment test
+    return clusters: List of (union xyxy box, [indices of the merged boxes])
+    '''
+    clusters = []
+    for i in np.argsort(-np.asarray(scores), kind="stable"):
+        box = boxes[i]
+        for cluster in clusters:
+            if _overlaps(cluster[0], box, iou_threshold, containment) or (cuts is not None and any(
+                    _seam_joined(boxes[j], cuts[j], box, cuts[i], containment) for j in cluster[1])):
+                cluster[0] = [min(cluster[0][0], box[0]), min(cluster[0][1], box[1]),
+                              max(cluster[0][2], box[2]), max(cluster[0][3], box[3])]
+                cluster[1].append(int(i))
+                break
+        else:
+            clusters.append([list(box), [int(i)]])
+    return [(np.array(box, dtype=np.float32), members) for box, members in clusters]
+
+
+def paste_mask(canvas, mask, tile, scale):
+    # OR a tile-level mask into its area of a canvas that is `scale` times the image size
+    x0, y0, x1, y1 = (int(round(v * scale)) for v in tile)
+    x1, y1 = min(x1, canvas.shape[1]), min(y1, canvas.shape[0])
+    if x1 <= x0 or y1 <= y0:
+        return
+    resized = cv2.resize(mask, (x1 - x0, y1 - y0), interpolation=cv2.INTER_NEAREST)
+    np.maximum(canvas[y0:y1, x0:x1], resized, out=canvas[y0:y1, x0:x1])
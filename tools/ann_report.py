@@ -0,0 +1,108 @@
+# Recall / latency report for the approximate (IVF / IVF-PQ) retrieval mode
+#
+# Ground truth is the exact cosine top-k. Queries are either a held-out
+# embedding index of real card crops (--queries) or perturbed copies of the
+# reference embeddings, which stand in for camera crops of the same cards.
+#
+# usage:
+#   python tools/ann_report.py res/classification_embeddings/Resnet18_embeddings.idx
+#   python tools/ann_report.py --synthetic 20000
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from ann_index import IVFIndex
+from embedding_index import load_index
+
+
+def synthetic_embeddings(count, dim=512, clusters=200, seed=0):
+    # clustered vectors, so that look-alike cards exist as they do in a real catalog
+    generator = torch.Generator().manual_seed(seed)
+    centres = torch.randn(clusters, dim, generator=generator)
+    members = torch.randint(0, clusters, (count,), generator=generator)
+    return F.normalize(centres[members] + 1.5 * torch.randn(count, dim, generator=generator), dim=1)
+
+
+def exact_top_k(embeddings, queries, k):
+    return torch.topk(queries @ embeddings.T, k, dim=1).indices
+
+
+def measure(search, queries, truth):
+    start = time.perf_counter()
+    results = search(queries)
+    elapsed = time.perf_counter() - start
+
+    # recall@1: the exact top-1 comes first; recall@5: share of the exact
+    # top-5 that the approximate top-5 contains
+    hits_1 = hits_5 = 0.0
+    for row, expected in zip(results, truth.tolist()):
+        hits_1 += bool(row) and row[0] == expected[0]
+        hits_5 += len(set(row[:5]) & set(expected[:5])) / 5
+    count = len(results)
+    return hits_1 / count, hits_5 / count, 1000 * elapsed / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall / latency report for the IVF retrieval mode")
+    parser.add_argument("embeddings", nargs="?", help="reference embedding index (.idx or .pt)")
+    parser.add_argument("--queries", help="embedding index of held-out crops, defaults to perturbed references")
+    parser.add_argument("--synthetic", type=int, default=None, help="use N synthetic references instead")
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.8, help="perturbation of the default queries")
+    parser.add_argument("--nlist", type=int, nargs="+", default=[64, 256])
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16, 32])
+    parser.add_argument("--pq-m", type=int, nargs="+", default=[0, 32, 64])
+    parser.add_argument("--rerank", type=int, default=50)
+    args = parser.parse_args()
+
+    if args.synthetic:
+        embeddings = synthetic_embeddings(args.synthetic)
+    elif args.embeddings:
+        embeddings = F.normalize(load_index(args.embeddings).embeddings.float(), dim=1)
+    else:
+        parser.error("pass an embeddings file or --synthetic N")
+
+    if args.queries:
+        queries = F.normalize(load_index(args.queries).embeddings.float(), dim=1)
+    else:
+        generator = torch.Generator().manual_seed(1)
+        picks = torch.randint(0, embeddings.shape[0], (args.num_queries,), generator=generator)
+        noise = torch.randn(len(picks), embeddings.shape[1], generator=generator) / embeddings.shape[1] ** 0.5
+        queries = F.normalize(embeddings[picks] + args.noise * noise, dim=1)
+
+    truth = exact_top_k(embeddings, queries, 5)
+
+    print(f"{embeddings.shape[0]} references, {queries.shape[0]} queries, dim {embeddings.shape[1]}")
+    print(f"{'mode':<28}{'nprobe':>8}{'recall@1':>10}{'recall@5':>10}{'ms/query':>10}")
+
+    # one query at a time, as the approximate modes are measured
+    _, _, exact_ms = measure(
+        lambda q: [exact_top_k(embeddings, q[i:i + 1], 5)[0].tolist() for i in range(len(q))],
+        queries, truth)
+    print(f"{'exact':<28}{'-':>8}{1.0:>10.3f}{1.0:>10.3f}{exact_ms:>10.3f}")
+
+    for nlist in args.nlist:
+        for pq_m in args.pq_m:
+            build_start = time.perf_counter()
+            index = IVFIndex(embeddings, nlist=nlist, pq_m=pq_m or None,
+                             rerank=args.rerank if pq_m else 0)
+            build_s = time.perf_counter() - build_start
+            mode = f"ivf{nlist}" + (f"-pq{pq_m}-rr{args.rerank}" if pq_m else "-flat")
+            print(f"# {mode} built in {build_s:.1f}s")
+            for nprobe in args.nprobe:
+                if nprobe > index.nlist:
+                    continue
+                recall_1, recall_5, ms = measure(
+                    lambda q: index.search(q, 5, nprobe=nprobe), queries, truth)
+                print(f"{mode:<28}{nprobe:>8}{recall_1:>10.3f}{recall_5:>10.3f}{ms:>10.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Parity and latency check for the embedding backends
+#
+# Exports the eager model to TorchScript and ONNX, embeds the same batches
+# with every backend and compares the outputs against eager PyTorch. Exits
+# with a non-zero status when any backend drifts past the tolerance, so it
+# can gate a deployment. The latency columns help pick the fastest runtime
+# for the host it runs on.
+#
+# usage:
+#   python tools/backend_parity.py --images image-hashing-trial/cropped --threads 4
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from embedding_backends import EMBEDDING_WEIGHTS, export, load_backend
+from retriever import make_transform
+
+
+def load_batch(image_dir, limit):
+    transform = make_transform()
+    names = sorted(n for n in os.listdir(image_dir) if n.lower().endswith(('.png', '.jpg', '.jpeg')))
+    return torch.stack([transform(Image.open(os.path.join(image_dir, n)).convert('RGB'))
+                        for n in names[:limit]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare embedding backends against eager PyTorch")
+    parser.add_argument("--weights", default=EMBEDDING_WEIGHTS)
+    parser.add_argument("--images", default=None, help="folder of crops, defaults to random inputs")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--atol", type=float, default=1e-3, help="max abs difference allowed")
+    parser.add_argument("--min-cosine", type=float, default=0.9999)
+    args = parser.parse_args()
+
+    if args.images:
+        batch = load_batch(args.images, args.batch_size)
+    else:
+        batch = torch.randn(args.batch_size, 3, 224, 224, generator=torch.Generator().manual_seed(0))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = {"eager": args.weights}
+        for kind, suffix in [("torchscript", ".ts"), ("onnx", ".onnx")]:
+            paths[kind] = os.path.join(tmp, "embedding" + suffix)
+            export(kind, paths[kind], args.weights)
+
+        reference = None
+        print(f"{'backend':<14}{'max abs diff':>14}{'min cosine':>12}{'ms/batch':>10}{'ms/image':>10}")
+        for kind in ["eager", "torchscript", "onnx"]:
+            backend = load_backend(kind, paths[kind], args.threads)
+            output = backend(batch)  # warm-up
+            start = time.perf_counter()
+            for _ in range(args.repeats):
+                output = backend(batch)
+            ms = 1000 * (time.perf_counter() - start) / args.repeats
+
+            if reference is None:
+                reference = output
+            diff = (output - reference).abs().max().item()
+            cosine = F.cosine_similarity(output, reference, dim=1).min().item()
+            ok = diff <= args.atol and cosine >= args.min_cosine
+            failed |= not ok
+            print(f"{kind:<14}{diff:>14.2e}{cosine:>12.6f}{ms:>10.1f}{ms / len(batch):>10.2f}"
+                  + ("" if ok else "  MISMATCH"))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
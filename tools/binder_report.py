@@ -0,0 +1,125 @@
+# Per-page latency of the binder grid fast path against the YOLO path
+#
+# Both paths end with the same batched embedding search over the card crops,
+# so only the stage that differs is timed: pocket grid fitting + slicing
+# against YOLO segmentation + mask cropping. Pages where no grid is found
+# are counted, those fall back to the YOLO path in Model.process_binder.
+# --synthetic lays card scans out on generated 9 / 12 pocket pages, for when
+# no binder photos are at hand.
+#
+# usage:
+#   python tools/binder_report.py res/binder_pages --weights res/detection_weights/yolo11n_seg_best_10epochs.onnx
+#   python tools/binder_report.py --synthetic res/card_images --pages 20
+
+import argparse
+import glob
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from binder import detect_grid, slice_pockets
+
+
+def synthetic_page(card_files, rows, cols, rng, card_width=378, seam=14, empty=0.1):
+    # pockets with dark seams on a light page, a few pockets left empty
+    card_height = round(card_width * 88 / 63)
+    height = rows * card_height + (rows + 1) * seam + 2 * rng.randint(10, 60)
+    width = cols * card_width + (cols + 1) * seam + 2 * rng.randint(10, 60)
+    page = np.full((height, width, 3), 200, dtype=np.uint8)
+    top, left = (height - rows * (card_height + seam) - seam) // 2, (width - cols * (card_width + seam) - seam) // 2
+    for r in range(rows):
+        for c in range(cols):
+            x, y = left + seam + c * (card_width + seam), top + seam + r * (card_height + seam)
+            page[y - seam:y + card_height + seam, x - seam:x + card_width + seam] = 60
+            if rng.random() < empty:
+                page[y:y + card_height, x:x + card_width] = 170
+            else:
+                card = cv2.imread(rng.choice(card_files))
+                page[y:y + card_height, x:x + card_width] = cv2.resize(card, (card_width, card_height))
+    # camera blur and sensor noise
+    page = cv2.GaussianBlur(page, (5, 5), 0)
+    noise = np.random.default_rng(rng.randint(0, 1 << 30)).normal(0, 8, page.shape)
+    return np.clip(page + noise, 0, 255).astype(np.uint8)
+
+
+def load_pages(args):
+    if args.synthetic:
+        card_files = sorted(f for f in glob.glob(os.path.join(args.synthetic, "*")) if cv2.haveImageReader(f))
+        rng = random.Random(0)
+        return [synthetic_page(card_files, *rng.choice([(3, 3), (4, 3)]), rng) for _ in range(args.pages)]
+    files = []
+    for path in args.images:
+        files += sorted(glob.glob(os.path.join(path, "*"))) if os.path.isdir(path) else [path]
+    return [cv2.imread(f) for f in files]
+
+
+def grid_path(frame):
+    img = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    grid = detect_grid(img)
+    if grid is None:
+        return None
+    return slice_pockets(img, grid)[1]
+
+
+def yolo_path(detector, frame):
+    detections = next(detector.detect_batch([frame]))
+    crops = []
+    for mask, bbox in zip(detections.masks, detections.bboxs):
+        x, y, w, h = bbox
+        x0, y0 = max(0, int(x - w / 2)), max(0, int(y - h / 2))
+        x1, y1 = int(x + w / 2), int(y + h / 2)
+        resized = cv2.resize(mask, (frame.shape[1], frame.shape[0]), interpolation=cv2.INTER_NEAREST)
+        crops.append(detections.image[y0:y1, x0:x1] * (resized[y0:y1, x0:x1, None] > 0))
+    return crops
+
+
+def time_per_page(run, pages, repeat):
+    times = []
+    for page in pages:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            run(page)
+        times.append((time.perf_counter() - start) / repeat)
+    return np.array(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Binder grid fast path vs YOLO latency per page")
+    parser.add_argument("images", nargs="*", help="binder page photos, or folders of them")
+    parser.add_argument("--synthetic", help="folder of card scans to build synthetic pages from")
+    parser.add_argument("--pages", type=int, default=20, help="number of synthetic pages")
+    parser.add_argument("--weights", help="YOLO segmentation weights, skip the YOLO path when missing")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    pages = load_pages(args)
+    if not pages:
+        parser.error("no pages, pass binder photos or --synthetic")
+
+    found = [grid_path(page) for page in pages]
+    hits = sum(crops is not None for crops in found)
+    print(f"{len(pages)} pages, grid found on {hits} ({hits / len(pages):.0%}), "
+          f"{sum(len(c) for c in found if c)} pocket crops")
+
+    rows = [("grid", time_per_page(grid_path, pages, args.repeat))]
+    if args.weights:
+        from detector import Detector
+        detector = Detector(args.weights)
+        yolo_path(detector, pages[0])  # warm-up
+        rows.append(("yolo", time_per_page(lambda page: yolo_path(detector, page), pages, args.repeat)))
+
+    print(f"{'path':<6} {'mean ms':>9} {'p50 ms':>9} {'p95 ms':>9}")
+    for name, times in rows:
+        print(f"{name:<6} {times.mean():9.1f} {np.percentile(times, 50):9.1f} {np.percentile(times, 95):9.1f}")
+    if len(rows) == 2:
+        print(f"grid path speed-up: {rows[1][1].mean() / rows[0][1].mean():.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+# Time and peak memory per card of the crop stage (Model.get_segmented_card)
+#
+# Compares the previous full-frame implementation (mask resized to the whole
+# image, whole image multiplied, then cropped and converted) with the
+# current ROI-only one, on a synthetic photo with cards laid out on a grid
+# and detector-sized masks. Both must produce identical crops, and so must
+# the ROI-only crop and a crop of the whole resized mask over random image,
+# mask and bbox geometries (where rounding at the ROI boundaries shows).
+#
+# usage:
+#   python tools/crop_benchmark.py --width 4000 --height 3000 --cards 12
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from model import Model
+
+
+def full_frame_crop(model, mask, bbox, img):
+    # the crop stage before the ROI-only rework
+    resized_mask = cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
+    cutout = resized_mask[..., None] * img
+    x_min, y_min, x_max, y_max = model.get_bbox_corner(bbox, img)
+    cropped_cutout = cutout[y_min:y_max, x_min:x_max]
+    return Image.fromarray((cropped_cutout * 255).astype(np.uint8))
+
+
+def synthetic_scene(width, height, cards, mask_width=640, seed=0):
+    # cards on a grid, each with a slightly inset elliptic-cornered mask
+    rng = np.random.default_rng(seed)
+    img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+    mask_height = round(mask_width * height / width)
+    cols = int(np.ceil(np.sqrt(cards * width / height)))
+    rows = int(np.ceil(cards / cols))
+    cell_w, cell_h = width / cols, height / rows
+    masks = np.zeros((cards, mask_height, mask_width), dtype=np.uint8)
+    bboxs = np.zeros((cards, 4), dtype=np.float32)
+    for k in range(cards):
+        r, c = divmod(k, cols)
+        x, y, w, h = (c + 0.5) * cell_w, (r + 0.5) * cell_h, cell_w * 0.8, cell_h * 0.8
+        bboxs[k] = [x, y, w, h]
+        sx, sy = mask_width / width, mask_height / height
+        cv2.rectangle(masks[k], (int((x - w / 2) * sx) + 2, int((y - h / 2) * sy) + 2),
+                      (int((x + w / 2) * sx) - 2, int((y + h / 2) * sy) - 2), 255, -1)
+    return img, masks, bboxs
+
+
+def reference_crop(model, mask, bbox, img):
+    # whole mask resized by OpenCV, then the bbox cropped, with the current masking
+    resized_mask = cv2.resize(mask, (img.shape[1], img.shape[0]), interpolation=cv2.INTER_NEAREST)
+    x_min, y_min, x_max, y_max = model.get_bbox_corner(bbox, img)
+    roi = img[y_min:y_max, x_min:x_max]
+    return Image.fromarray(cv2.bitwise_and(roi, roi, mask=resized_mask[y_min:y_max, x_min:x_max]))
+
+
+def random_geometry_mismatches(model, cases, seed=1):
+    # cases where the ROI-only crop differs from the reference crop
+    rng = np.random.default_rng(seed)
+    mismatches = 0
+    for _ in range(cases):
+        height, width = (int(v) for v in rng.integers(64, 1600, 2))
+        mask_height, mask_width = (int(v) for v in rng.integers(16, 640, 2))
+        img = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        mask = (rng.random((mask_height, mask_width)) < 0.5).astype(np.uint8) * 255
+        w, h = rng.uniform(8, width), rng.uniform(8, height)
+        bbox = [rng.uniform(0, width), rng.uniform(0, height), w, h]
+        ours = np.asarray(Model.get_segmented_card(model, mask, bbox, img))
+        mismatches += not np.array_equal(ours, np.asarray(reference_crop(model, mask, bbox, img)))
+    return mismatches
+
+
+def measure(crop, model, img, masks, bboxs, repeat):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        crops = [crop(model, mask, bbox, img) for mask, bbox in zip(masks, bboxs)]
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return crops, elapsed / (repeat * len(masks)) * 1000, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Crop stage time and peak memory per card, before vs after")
+    parser.add_argument("--width", type=int, default=4000)
+    parser.add_argument("--height", type=int, default=3000)
+    parser.add_argument("--cards", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--random-cases", type=int, default=300, help="random geometries checked against cv2.resize")
+    args = parser.parse_args()
+
+    # the crop stage needs neither the detector nor the index
+    model = Model.__new__(Model)
+    img, masks, bboxs = synthetic_scene(args.width, args.height, args.cards)
+
+    before, before_ms, before_mb = measure(full_frame_crop, model, img, masks, bboxs, args.repeat)
+    after, after_ms, after_mb = measure(Model.get_segmented_card, model, img, masks, bboxs, args.repeat)
+
+    same = all(np.array_equal(np.asarray(a), np.asarray(b)) for a, b in zip(before, after))
+    print(f"{args.width}x{args.height} image, {args.cards} cards, crops identical: {same}")
+    mismatches = random_geometry_mismatches(model, args.random_cases)
+    print(f"random geometries: {mismatches} of {args.random_cases} crops differ from cv2.resize")
+    print(f"{'':<12} {'ms / card':>10} {'peak MB':>9}")
+    print(f"{'full frame':<12} {before_ms:10.2f} {before_mb:9.1f}")
+    print(f"{'roi only':<12} {after_ms:10.2f} {after_mb:9.1f}")
+    if not same or mismatches:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
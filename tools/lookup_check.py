@@ -0,0 +1,185 @@
+# Checks CardLookup against a local stub of the card API
+#
+# The stub serves cards from a bulk JSON dump with artificial latency, and
+# injects failures: some cards answer 503 on their first request, some hang
+# past the client timeout on their first request, and unknown ids are 404.
+# One page worth of cards is looked up sequentially and concurrently; the
+# script checks every card's outcome and attempt count, that both paths
+# resolve the same cards with the same errors, prints the timings
+# and exits non-zero when a check fails. Then several threads and an asyncio
+# caller look the same page up at once, and the stub must have been asked
+# for each card only as often as a single lookup would.
+#
+# usage:
+#   python tools/lookup_check.py --cards cards/base1.json --latency 0.3 --concurrency 8
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from card_lookup import CardLookup
+
+# bulk dumps leave out the set, which the API embeds in every card
+STUB_SET = {"id": "stub", "name": "Stub", "series": "Stub", "printedTotal": 0, "total": 0,
+            "legalities": {}, "ptcgoCode": None, "releaseDate": "1999/01/09",
+            "updatedAt": "2020/08/14 09:35:00", "images": {"symbol": "", "logo": ""}}
+
+
+class StubApi:
+    def __init__(self, cards, latency, jitter, flaky, hanging, hang_time) -> None:
+        self.cards = cards
+        self.latency = latency
+        self.jitter = jitter
+        self.flaky = flaky        # card ids answering 503 on their first request
+        self.hanging = hanging    # card ids stalling on their first request
+        self.hang_time = hang_time
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.attempts = {}
+
+    def handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                card_id = self.path.rstrip("/").rsplit("/", 1)[-1]
+                with api.lock:
+                    attempt = api.attempts[card_id] = api.attempts.get(card_id, 0) + 1
+                if card_id in api.hanging and attempt == 1:
+                    time.sleep(api.hang_time)
+                time.sleep(max(0.0, api.latency + random.uniform(-api.jitter, api.jitter)))
+
+                if card_id in api.flaky and attempt == 1:
+                    status, body = 503, {"error": "unavailable"}
+                elif card_id not in api.cards:
+                    status, body = 404, {"error": "not found"}
+                else:
+                    status, body = 200, {"data": api.cards[card_id]}
+                payload = json.dumps(body).encode("utf-8")
+                try:
+                    self.send_response(status)
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(payload)))
+                    self.end_headers()
+                    self.wfile.write(payload)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client timed out and went away
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+def load_cards(path):
+    with open(path, "r", encoding="utf-8") as f:
+        cards = json.load(f)
+    return {card["id"]: dict(card, set=card.get("set", STUB_SET)) for card in cards}
+
+
+def outcome(result):
+    # what a lookup resolved to: card id and name, or the error type and message
+    if result.ok:
+        return result.card_id, result.card.id, result.card.name
+    return result.card_id, type(result.error).__name__, str(result.error)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CardLookup against a local latency-injecting stub API")
+    parser.add_argument("--cards", default="cards/base1.json", help="bulk card JSON dump to serve")
+    parser.add_argument("--page", type=int, default=9, help="cards looked up together")
+    parser.add_argument("--latency", type=float, default=0.3, help="seconds per stub response")
+    parser.add_argument("--jitter", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    parser.add_argument("--duplicates", type=int, default=4, help="concurrent callers per card in the coalescing check")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    cards = load_cards(args.cards)
+    page = random.sample(sorted(cards), args.page)
+    flaky, hanging = set(page[:2]), set(page[2:3])
+    missing = "stub-404"
+
+    api = StubApi(cards, args.latency, args.jitter, flaky, hanging, hang_time=args.timeout * 2)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), api.handler())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_address[1]}/v2"
+
+    lookup = CardLookup(endpoint, api_key="stub", max_concurrency=args.concurrency,
+                        timeout=args.timeout, retries=3, backoff=0.1)
+    card_ids = page + [missing]
+
+    start = time.perf_counter()
+    sequential = [lookup.find(card_id) for card_id in card_ids]
+    sequential_time = time.perf_counter() - start
+
+    api.reset()
+    start = time.perf_counter()
+    concurrent = lookup.find_all(card_ids)
+    concurrent_time = time.perf_counter() - start
+
+    # coalescing: duplicate lookups from threads and from asyncio at the same time
+    api.reset()
+    coalesced = lookup.flights.stats["coalesced"]
+    callers = [threading.Thread(target=lookup.find_all, args=(card_ids,)) for _ in range(args.duplicates - 1)]
+    start = time.perf_counter()
+    for caller in callers:
+        caller.start()
+    asyncio.run(lookup.find_all_async(card_ids))
+    for caller in callers:
+        caller.join()
+    duplicate_time = time.perf_counter() - start
+    coalesced = lookup.flights.stats["coalesced"] - coalesced
+    server.shutdown()
+    lookup.close()
+
+    failures = []
+    # both paths must resolve the same cards, in order, with the same errors
+    for one, other in zip(sequential, concurrent):
+        if outcome(one) != outcome(other):
+            failures.append(f"{one.card_id}: sequential {outcome(one)}, concurrent {outcome(other)}")
+    if [r.card_id for r in sequential] != [r.card_id for r in concurrent]:
+        failures.append("sequential and concurrent results are not in the same order")
+    for card_id in card_ids:
+        expected_attempts = 2 if card_id in flaky | hanging else 1
+        if api.attempts.get(card_id, 0) != expected_attempts:
+            failures.append(f"{card_id}: {api.attempts.get(card_id, 0)} requests from {args.duplicates} "
+                            f"concurrent callers, expected {expected_attempts}")
+    for result in concurrent:
+        expected_attempts = 2 if result.card_id in flaky | hanging else 1
+        if result.card_id == missing:
+            if result.ok or not isinstance(result.error, LookupError):
+                failures.append(f"{missing} should fail with LookupError, got {result.error!r}")
+        elif not result.ok or result.card.name != cards[result.card_id]["name"]:
+            failures.append(f"{result.card_id} failed: {result.error!r}")
+        if result.attempts != expected_attempts:
+            failures.append(f"{result.card_id}: {result.attempts} attempts, expected {expected_attempts}")
+        status = result.card.name if result.ok else f"error: {result.error}"
+        print(f"{result.card_id:<12} attempts {result.attempts}  {result.elapsed:5.2f}s  {status}")
+
+    print(f"sequential {sequential_time:.2f}s, concurrent {concurrent_time:.2f}s "
+          f"({sequential_time / concurrent_time:.1f}x) for {len(card_ids)} cards")
+    print(f"{args.duplicates} concurrent callers {duplicate_time:.2f}s, {coalesced} of "
+          f"{args.duplicates * len(card_ids)} lookups coalesced, {sum(api.attempts.values())} requests")
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
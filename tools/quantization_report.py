@@ -0,0 +1,83 @@
+# Memory / accuracy report for compressed (float16 / int8) embedding storage
+#
+# Top-1 accuracy is measured on a held-out crop set: an embedding index of
+# real card crops whose card ids are the true labels (--queries). Without one,
+# perturbed copies of the reference embeddings labelled with their source
+# card are used instead.
+#
+# usage:
+#   python tools/quantization_report.py res/classification_embeddings/Resnet18_embeddings.idx --queries crops.idx
+#   python tools/quantization_report.py --synthetic 20000
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from ann_report import synthetic_embeddings
+from embedding_index import QuantizedEmbeddings, load_index, quantize
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memory / accuracy report for compressed embedding storage")
+    parser.add_argument("embeddings", nargs="?", help="reference embedding index (.idx or .pt)")
+    parser.add_argument("--queries", help="embedding index of labelled held-out crops")
+    parser.add_argument("--synthetic", type=int, default=None, help="use N synthetic references instead")
+    parser.add_argument("--num-queries", type=int, default=500)
+    parser.add_argument("--noise", type=float, default=0.8, help="perturbation of the default queries")
+    parser.add_argument("--rerank", type=int, nargs="+", default=[0, 8, 32])
+    args = parser.parse_args()
+
+    if args.synthetic:
+        embeddings = synthetic_embeddings(args.synthetic)
+        card_ids = [str(i) for i in range(args.synthetic)]
+    elif args.embeddings:
+        index = load_index(args.embeddings)
+        embeddings, card_ids = F.normalize(index.embeddings.float(), dim=1), index.card_ids
+    else:
+        parser.error("pass an embeddings file or --synthetic N")
+
+    if args.queries:
+        held_out = load_index(args.queries)
+        queries, labels = F.normalize(held_out.embeddings.float(), dim=1), held_out.card_ids
+    else:
+        generator = torch.Generator().manual_seed(1)
+        picks = torch.randint(0, embeddings.shape[0], (args.num_queries,), generator=generator)
+        noise = torch.randn(len(picks), embeddings.shape[1], generator=generator) / embeddings.shape[1] ** 0.5
+        queries = F.normalize(embeddings[picks] + args.noise * noise, dim=1)
+        labels = [card_ids[i] for i in picks.tolist()]
+
+    def accuracy(rows):
+        return sum(card_ids[row[0]] == label for row, label in zip(rows, labels)) / len(labels)
+
+    full_bytes = embeddings.numel() * 4
+    print(f"{embeddings.shape[0]} references, {queries.shape[0]} held-out queries, dim {embeddings.shape[1]}")
+    print(f"{'storage':<18}{'rerank':>8}{'scanned MB':>12}{'saved':>8}{'top-1':>8}{'ms/query':>10}")
+
+    start = time.perf_counter()
+    exact = [torch.topk(q @ embeddings.T, 1).indices.tolist() for q in queries]
+    exact_ms = 1000 * (time.perf_counter() - start) / len(queries)
+    exact_acc = accuracy(exact)
+    print(f"{'float32':<18}{'-':>8}{full_bytes / 2**20:>12.1f}{'0%':>8}{exact_acc:>8.3f}{exact_ms:>10.3f}")
+
+    for storage, scale_mode in [("float16", None), ("int8", "vector"), ("int8", "dimension")]:
+        codes, scales = quantize(embeddings.numpy(), storage, scale_mode or "vector")
+        quantized = QuantizedEmbeddings(codes, scales, scale_mode)
+        name = storage + (f"/{scale_mode}" if scale_mode else "")
+        saved = 1 - quantized.nbytes / full_bytes
+        for rerank in args.rerank:
+            start = time.perf_counter()
+            rows = [quantized.search(q.unsqueeze(0), embeddings, 1, rerank)[0] for q in queries]
+            ms = 1000 * (time.perf_counter() - start) / len(queries)
+            acc = accuracy(rows)
+            print(f"{name:<18}{rerank:>8}{quantized.nbytes / 2**20:>12.1f}{saved:>8.0%}"
+                  f"{acc:>8.3f}{ms:>10.3f}  ({acc - exact_acc:+.3f} vs float32)")
+
+
+if __name__ == "__main__":
+    main()
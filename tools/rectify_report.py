@@ -0,0 +1,110 @@
+# Accuracy / latency of bbox crops vs perspective-rectified crops, per
+# embedding input size
+#
+# Card scans are pasted into synthetic camera shots with a random rotation,
+# perspective tilt and background, together with their (exact) card mask.
+# Every shot is cropped both ways, embedded at each input size and matched
+# against reference embeddings of the scans computed at the same size, as
+# build_index.py --input-size would.
+#
+# usage:
+#   python tools/rectify_report.py images --count 300 --sizes 224 160 128
+
+import argparse
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+from build_index import scan_images
+from embedding_backends import EMBEDDING_WEIGHTS, EagerBackend
+from model import Model
+from rectify import rectify_card
+from retriever import make_transform
+
+
+def camera_shot(card, rng, width=640, height=480):
+    # the card rotated, tilted and placed on a cluttered background; returns
+    # the RGB shot, its uint8 card mask and the card's xywh bbox
+    shot = cv2.GaussianBlur(rng.integers(0, 256, (height // 8, width // 8, 3), dtype=np.uint8), (3, 3), 0)
+    shot = cv2.resize(shot, (width, height), interpolation=cv2.INTER_LINEAR)
+
+    card_height = height * rng.uniform(0.5, 0.8)
+    card_width = card_height * 63 / 88
+    corners = np.array([[-1, -1], [1, -1], [1, 1], [-1, 1]], dtype=np.float32) / 2
+    corners *= [card_width, card_height]
+    corners += rng.normal(0, 0.05, corners.shape) * [card_width, card_height]  # perspective tilt
+    angle = np.radians(rng.uniform(-30, 30))
+    rotation = np.array([[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]])
+    corners = corners @ rotation.T + [width / 2 + rng.uniform(-40, 40), height / 2 + rng.uniform(-30, 30)]
+
+    source = np.array([[0, 0], [card.shape[1], 0], [card.shape[1], card.shape[0]], [0, card.shape[0]]],
+                      dtype=np.float32)
+    transform = cv2.getPerspectiveTransform(source, corners.astype(np.float32))
+    warped = cv2.warpPerspective(card, transform, (width, height))
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.fillConvexPoly(mask, corners.round().astype(np.int32), 255)
+    shot[mask > 0] = warped[mask > 0]
+
+    x0, y0 = corners.min(axis=0)
+    x1, y1 = corners.max(axis=0)
+    return shot, mask, np.array([(x0 + x1) / 2, (y0 + y1) / 2, x1 - x0, y1 - y0], dtype=np.float32)
+
+
+def embed(backend, images, size, batch_size=32):
+    transform = make_transform(size)
+    vectors = []
+    for start in range(0, len(images), batch_size):
+        vectors.append(backend(torch.stack([transform(image) for image in images[start:start + batch_size]])))
+    return F.normalize(torch.cat(vectors), dim=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="bbox vs rectified crops, accuracy and latency per input size")
+    parser.add_argument("image_dir", help="folder of <card id>.png reference scans")
+    parser.add_argument("--count", type=int, default=300, help="number of cards to test on")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[224, 160])
+    parser.add_argument("--weights", default=EMBEDDING_WEIGHTS, help="embedding model weights")
+    parser.add_argument("--threads", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    paths = list(scan_images(args.image_dir).values())[:args.count]
+    scans = [np.asarray(Image.open(path).convert('RGB')) for path in paths]
+    shots = [camera_shot(scan, rng) for scan in scans]
+    backend = EagerBackend(args.weights, args.threads)
+    # the crop stage needs neither the detector nor the index
+    cropper = Model.__new__(Model)
+
+    print(f"{len(shots)} cards")
+    print(f"{'crop':<10} {'size':>5} {'top-1':>7} {'crop ms':>9} {'embed ms':>9}")
+    for size in args.sizes:
+        references = embed(backend, [Image.fromarray(scan) for scan in scans], size)
+        truth = torch.arange(len(scans))
+        methods = {
+            "bbox": lambda shot, mask, bbox: cropper.get_segmented_card(mask, bbox, shot),
+            "rectified": lambda shot, mask, bbox: Image.fromarray(rectify_card(shot, mask, size)),
+        }
+        for name, crop in methods.items():
+            start = time.perf_counter()
+            crops = [crop(*shot) for shot in shots]
+            crop_ms = (time.perf_counter() - start) / len(shots) * 1000
+
+            start = time.perf_counter()
+            queries = embed(backend, crops, size)
+            embed_ms = (time.perf_counter() - start) / len(shots) * 1000
+
+            top1 = ((queries @ references.T).argmax(dim=1) == truth).float().mean().item()
+            print(f"{name:<10} {size:>5} {top1:7.1%} {crop_ms:9.2f} {embed_ms:9.2f}")
+
+
+if __name__ == "__main__":
+    main()
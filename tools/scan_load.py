@@ -0,0 +1,127 @@
+# Load generator for the scan service (src/scan_server.py)
+#
+# Sends photos from a folder to /scan from a number of concurrent clients,
+# each posting its next photo as soon as the previous answer arrived, and
+# reports the throughput, the latency percentiles, the refused (503) requests
+# and the server's batching counters. Compare runs with a server started with
+# --max-batch 1 to see what the micro-batching gains. --serve starts the
+# server in this process instead of using a running one.
+#
+# usage:
+#   python tools/scan_load.py res/photos --url http://127.0.0.1:8765 --concurrency 16 --requests 200
+#   python tools/scan_load.py res/photos --serve --max-batch 8 --concurrency 16
+
+import argparse
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import requests
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def wait_ready(url, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(f"{url}/readyz", timeout=1).status_code == 200:
+                return True
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def run_load(url, photos, concurrency, total, params=None):
+    '''
+    Posts total photos from concurrency clients
+    return latencies, statuses, batch sizes, elapsed: Seconds per successful
+        request, status code per request, server batch size per successful request
+    '''
+    latencies, statuses, batch_sizes = [], [], []
+    lock = threading.Lock()
+    counter = iter(range(total))
+
+    def client():
+        session = requests.Session()
+        for i in counter:
+            start = time.perf_counter()
+            response = session.post(f"{url}/scan", data=photos[i % len(photos)], params=params, timeout=120)
+            latency = time.perf_counter() - start
+            with lock:
+                statuses.append(response.status_code)
+                if response.status_code == 200:
+                    latencies.append(latency)
+                    batch_sizes.append(response.json()["timing"]["batch_size"])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(client) for _ in range(concurrency)]:
+            future.result()
+    return latencies, statuses, batch_sizes, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Concurrent clients against the scan service")
+    parser.add_argument("folder", help="folder of photos to post")
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--lookup", action="store_true", help="let the service look the card names up")
+    parser.add_argument("--serve", action="store_true", help="start the service in this process")
+    parser.add_argument("--max-batch", type=int, default=8, help="with --serve")
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="with --serve")
+    parser.add_argument("--max-queue", type=int, default=32, help="with --serve")
+    parser.add_argument("--detector", default=None, help="with --serve")
+    parser.add_argument("--index", default=None, help="with --serve")
+    parser.add_argument("--embedding-model", default=None, help="with --serve")
+    args = parser.parse_args()
+
+    photos = []
+    for name in sorted(os.listdir(args.folder)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(args.folder, name), "rb") as f:
+                photos.append(f.read())
+    if not photos:
+        parser.error(f"no images in {args.folder}")
+
+    url = args.url.rstrip("/")
+    if args.serve:
+        from scan_server import serve
+        server = serve(port=0, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000,
+                       max_queue=args.max_queue, detector_path=args.detector, index_path=args.index,
+                       embedding_model_path=args.embedding_model)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+    if not wait_ready(url, timeout=300):
+        sys.exit(f"{url} did not become ready")
+    before = requests.get(f"{url}/stats", timeout=5).json()
+
+    latencies, statuses, batch_sizes, elapsed = run_load(url, photos, args.concurrency, args.requests,
+                                                         {"lookup": "1" if args.lookup else "0"})
+    after = requests.get(f"{url}/stats", timeout=5).json()
+
+    ok = len(latencies)
+    refused = statuses.count(503)
+    print(f"{args.requests} requests from {args.concurrency} clients in {elapsed:.1f}s: "
+          f"{ok} ok, {refused} refused (503), {len(statuses) - ok - refused} other errors")
+    if ok:
+        p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+        print(f"throughput {ok / elapsed:.1f} photos/s, latency p50 {p50:.0f} ms, p95 {p95:.0f} ms, p99 {p99:.0f} ms")
+        print(f"mean batch size {np.mean(batch_sizes):.2f}")
+    batches = after["batches"] - before["batches"]
+    if batches:
+        print(f"server: {batches} batches, {after['images'] - before['images']} photos, "
+              f"{after['cards'] - before['cards']} cards, largest batch {after['max_batch_seen']}")
+    if args.serve:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()